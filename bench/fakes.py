@@ -0,0 +1,349 @@
+"""
+Local stand-ins for the Gmail, Sheets, Classroom and Salesforce APIs,
+serving a synthetic dataset, so the clients can be benchmarked offline.
+
+The Google fake is an httplib2-style transport installed with
+`package.client.set_http_factory`; the Salesforce fake is a requests
+transport adapter mounted on the session given to `AttendanceClient`.
+"""
+
+import base64
+import csv
+import io
+import json
+import random
+import threading
+import time
+from collections import Counter
+from email.parser import FeedParser
+from urllib.parse import parse_qs, urlsplit
+
+import httplib2
+import requests
+from requests.adapters import BaseAdapter
+
+
+HEADERS = ["First name", "Last name", "Email",
+           "Duration", "Time joined", "Time exited"]
+FIRST_NAMES = ["Sanawar", "Ayesha", "Bilal", "Fatima", "Hamza", "Zainab",
+               "Usman", "Maryam", "Ali", "Hira", "Omar", "Sana"]
+LAST_NAMES = ["Saeed", "Khan", "Ahmed", "Malik", "Hussain", "Raza",
+              "Iqbal", "Shah", "Butt", "Qureshi", "Aslam", "Javed"]
+
+
+def meet_code(index):
+    letters = []
+    for _ in range(10):
+        index, remainder = divmod(index, 26)
+        letters.append(chr(ord("a") + remainder))
+    code = "".join(letters)
+    return f"{code[:3]}-{code[3:7]}-{code[7:]}"
+
+
+class Dataset:
+    """Synthetic courses, rosters and meetings."""
+
+    def __init__(self, courses=50, students=30, meetings=20, attendance_rate=0.8, seed=0) -> None:
+        rng = random.Random(seed)
+        self.courses = []
+        self.rosters = {}
+        self.meetings = []
+
+        for index in range(courses):
+            course_id = str(600000000000 + index)
+            section = f"CS-F24-{index:03d}-L"
+            self.courses.append({
+                "id": course_id,
+                "name": f"Course {index}",
+                "alternateLink": f"https://classroom.google.com/c/{course_id}",
+                "description": section,
+                "room": f"https://meet.google.com/{meet_code(index)}",
+                "creationTime": f"2024-09-{1 + index % 28:02d}T08:00:00.000Z",
+                "updateTime": f"2024-10-{1 + index % 28:02d}T08:00:00.000Z",
+            })
+            self.rosters[course_id] = [
+                (rng.choice(FIRST_NAMES), f"{rng.choice(LAST_NAMES)}{number} {section}")
+                for number in range(students)
+            ]
+
+        # newest first, like courses.list
+        self.courses.reverse()
+
+        for index in range(meetings):
+            course = self.courses[index % courses]
+            rows = [HEADERS]
+            for first, last in self.rosters[course["id"]]:
+                if rng.random() < attendance_rate:
+                    minutes = rng.randint(5, 90)
+                    rows.append([first, last, f"{first}.{last.split()[0]}@example.com".lower(),
+                                 f"{minutes} min", "10:00 AM", "11:00 AM"])
+            self.meetings.append({
+                "message_id": f"msg{index:06d}",
+                "spreadsheet_id": f"sheet{index:06d}",
+                "title": f"Meeting attendance {course['room'].split('/')[-1]} - 2024-10-{1 + index % 28:02d}",
+                "internal_date": str(1727740800000 + index * 3600000),
+                "rows": rows,
+            })
+
+    def message_body(self, meeting):
+        html = ('<p>Meeting records from your meeting are ready.</p>'
+                f'<a href="https://docs.google.com/spreadsheets/d/{meeting["spreadsheet_id"]}/edit">'
+                'Attendance</a>')
+        return base64.urlsafe_b64encode(html.encode()).decode().rstrip("=")
+
+
+class FakeGoogle:
+    """Shared state of the fake Google APIs: the dataset and call counters."""
+
+    def __init__(self, dataset: Dataset, latency=0.0, error_rate=0.0, page_size=100, seed=0) -> None:
+        self.dataset = dataset
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.calls = Counter()
+        self.response_bytes = 0
+        self.__rng = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__meetings = {meeting["message_id"]: meeting for meeting in dataset.meetings}
+        self.__sheets = {meeting["spreadsheet_id"]: meeting for meeting in dataset.meetings}
+        self.__students = {
+            course_id: [
+                {"courseId": course_id, "userId": f"{course_id}-{number}",
+                 "profile": {"name": {"fullName": f"{first} {last}"}}}
+                for number, (first, last) in enumerate(roster)
+            ]
+            for course_id, roster in dataset.rosters.items()
+        }
+
+    def http(self):
+        return FakeGoogleHttp(self)
+
+    def __fail(self):
+        with self.__lock:
+            return self.__rng.random() < self.error_rate
+
+    def __count(self, service, size):
+        with self.__lock:
+            self.calls[service] += 1
+            self.response_bytes += size
+
+    def handle(self, method, uri, body=None, headers=None):
+        """Returns (status, headers, body) for one request."""
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlsplit(uri)
+
+        # googleapiclient posts Gmail batches to /batch (older versions to
+        # /batch/gmail/v1)
+        if url.path == "/batch" or url.path.startswith("/batch/"):
+            return self.__batch(body, headers)
+
+        status, content = self.__route(method, url.path, parse_qs(url.query), body)
+        content = json.dumps(content).encode()
+        self.__count(url.hostname.split(".")[0], len(content))
+        return status, {"content-type": "application/json; charset=UTF-8"}, content
+
+    def __page(self, items, key, query):
+        requested = query.get("pageSize") or query.get("maxResults") or ["100"]
+        size = min(int(requested[0]), self.page_size)
+        start = int(query.get("pageToken", ["0"])[0] or 0)
+        page = {key: items[start:start + size]}
+        if start + size < len(items):
+            page["nextPageToken"] = str(start + size)
+        return page
+
+    def __route(self, method, path, query, body):
+        if self.__fail():
+            return 503, {"error": {"code": 503, "message": "Backend Error"}}
+
+        parts = path.strip("/").split("/")
+
+        # Classroom
+        if parts[:2] == ["v1", "courses"] and len(parts) == 2:
+            return 200, self.__page(self.dataset.courses, "courses", query)
+        if parts[:2] == ["v1", "courses"] and parts[3:] == ["students"]:
+            return 200, self.__page(self.__students.get(parts[2], []), "students", query)
+
+        # Sheets
+        if parts[:2] == ["v4", "spreadsheets"]:
+            meeting = self.__sheets.get(parts[2])
+            if meeting is None:
+                return 404, {"error": {"code": 404, "message": "Not found"}}
+            return 200, {
+                "properties": {"title": meeting["title"]},
+                "sheets": [{"data": [{"rowData": [
+                    {"values": [{"formattedValue": value} for value in row]}
+                    for row in meeting["rows"]
+                ]}]}],
+            }
+
+        # Gmail
+        if parts[:4] == ["gmail", "v1", "users", "me"]:
+            resource = parts[4:]
+            if resource == ["messages"]:
+                refs = [{"id": meeting["message_id"], "threadId": meeting["message_id"]}
+                        for meeting in self.dataset.meetings]
+                return 200, self.__page(refs, "messages", query)
+            if resource == ["messages", "batchModify"]:
+                return 204, {}
+            if resource[0] == "messages":
+                meeting = self.__meetings[resource[1]]
+                return 200, {
+                    "id": meeting["message_id"],
+                    "internalDate": meeting["internal_date"],
+                    "payload": {"parts": [{"body": {"data": self.dataset.message_body(meeting)}}]},
+                }
+            if resource == ["profile"]:
+                return 200, {"historyId": "1"}
+            if resource == ["history"]:
+                return 200, {"historyId": "1"}
+
+        return 404, {"error": {"code": 404, "message": f"No fake for {method} {path}"}}
+
+    def __batch(self, body, headers):
+        if isinstance(body, bytes):
+            body = body.decode()
+        # oauth2client sends the header names as bytes
+        headers = {(key.decode() if isinstance(key, bytes) else key).lower():
+                   value.decode() if isinstance(value, bytes) else value
+                   for key, value in headers.items()}
+        parser = FeedParser()
+        parser.feed(f"content-type: {headers['content-type']}\r\n\r\n{body}")
+        boundary = "fake_batch_boundary"
+        responses = []
+
+        for part in parser.close().get_payload():
+            request_line = part.get_payload().lstrip().split("\n", 1)[0]
+            method, path, _ = request_line.split(" ", 2)
+            url = urlsplit(path)
+            status, content = self.__route(method, url.path, parse_qs(url.query), None)
+            content = json.dumps(content)
+            self.__count("gmail", len(content))
+            responses.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{content}\r\n"
+            )
+
+        content = ("".join(responses) + f"--{boundary}--").encode()
+        return 200, {"content-type": f"multipart/mixed; boundary={boundary}"}, content
+
+
+class FakeGoogleHttp:
+    """httplib2.Http stand-in answering from a `FakeGoogle`."""
+
+    def __init__(self, google: FakeGoogle) -> None:
+        self.google = google
+        self.timeout = None
+        self.redirect_codes = set()
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=None, connection_type=None):
+        status, response_headers, content = self.google.handle(
+            method, uri, body, headers or {})
+        response = httplib2.Response(dict(response_headers, status=str(status)))
+        return response, content
+
+    def close(self):
+        pass
+
+
+class FakeSalesforceAdapter(BaseAdapter):
+    """requests transport adapter standing in for the Salesforce REST API."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0) -> None:
+        super().__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.records = 0
+        self.__rng = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__ids = 0
+        self.__jobs = {}
+
+    def session(self):
+        session = requests.Session()
+        session.mount("https://", self)
+        return session
+
+    def __new_id(self, prefix="a0X"):
+        with self.__lock:
+            self.__ids += 1
+            return f"{prefix}{self.__ids:015d}"
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        path = urlsplit(request.url).path
+        parts = path.strip("/").split("/")[3:]  # after services/data/vXX.X
+        with self.__lock:
+            self.calls[parts[0] if parts else "other"] += 1
+            failed = self.__rng.random() < self.error_rate
+
+        if failed:
+            return self.__response(request, 503, [{"errorCode": "SERVER_UNAVAILABLE",
+                                                   "message": "Fake outage"}])
+
+        body = request.body.decode() if isinstance(request.body, bytes) else request.body
+
+        if parts[:2] == ["composite", "sobjects"]:
+            records = json.loads(body)["records"]
+            with self.__lock:
+                self.records += len(records)
+            return self.__response(request, 200, [
+                {"id": self.__new_id(), "success": True, "errors": []} for _ in records
+            ])
+        if parts[0] == "sobjects" and request.method == "POST":
+            with self.__lock:
+                self.records += 1
+            return self.__response(request, 201, {"id": self.__new_id(), "success": True, "errors": []})
+        if parts[0] == "query":
+            return self.__response(request, 200, {"totalSize": 0, "done": True, "records": []})
+        if parts[:2] == ["jobs", "ingest"]:
+            return self.__bulk(request, parts[2:], body)
+
+        return self.__response(request, 404, [{"errorCode": "NOT_FOUND", "message": path}])
+
+    def __bulk(self, request, parts, body):
+        if not parts:
+            job_id = self.__new_id("750")
+            self.__jobs[job_id] = {"id": job_id, "state": "Open", "rows": []}
+            return self.__response(request, 200, self.__jobs[job_id])
+        job = self.__jobs[parts[0]]
+        if parts[1:] == ["batches"]:
+            job["rows"] = list(csv.DictReader(io.StringIO(body)))
+            with self.__lock:
+                self.records += len(job["rows"])
+            return self.__response(request, 201, None)
+        if parts[1:] == ["successfulResults"]:
+            buffer = io.StringIO()
+            columns = ["sf__Id", "sf__Created"] + \
+                (list(job["rows"][0].keys()) if job["rows"] else [])
+            writer = csv.DictWriter(buffer, columns, lineterminator="\n")
+            writer.writeheader()
+            for row in job["rows"]:
+                writer.writerow(dict(row, sf__Id=self.__new_id(), sf__Created="true"))
+            return self.__response(request, 200, buffer.getvalue(), "text/csv")
+        if parts[1:] == ["failedResults"]:
+            return self.__response(request, 200, "sf__Id,sf__Error\n", "text/csv")
+        if request.method == "PATCH":
+            job["state"] = "JobComplete"
+        return self.__response(request, 200, {k: v for k, v in job.items() if k != "rows"})
+
+    @staticmethod
+    def __response(request, status, content, content_type="application/json"):
+        response = requests.Response()
+        response.status_code = status
+        response.request = request
+        response.url = request.url
+        response.headers["Content-Type"] = content_type
+        if content is not None and content_type == "application/json":
+            content = json.dumps(content)
+        response._content = (content or "").encode()
+        return response
+
+    def close(self):
+        pass
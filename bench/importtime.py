@@ -0,0 +1,107 @@
+"""
+Startup benchmark: measures the import time of the entry point and the
+client modules with `python -X importtime`, and exits with an error if
+any of them goes over its budget in `bench/import_budget.json`
+(milliseconds), or if importing main.py loads a heavy library.
+
+    python -m bench.importtime
+    python -m bench.importtime --modules main package.classroom --top 10
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_PATH = os.path.join(ROOT, "bench", "import_budget.json")
+
+# Libraries main.py must leave to the runs that use them.
+HEAVY_MODULES = ("googleapiclient", "google_auth_oauthlib", "google_auth_httplib2",
+                 "simplegmail", "oauth2client", "simple_salesforce", "zeep", "lxml",
+                 "pytz")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Import time benchmark")
+    parser.add_argument("--modules", nargs="+",
+                        help="modules to measure (default: every module of the budget)")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="imports per module; the fastest one counts (default: 3)")
+    parser.add_argument("--top", type=int, default=5,
+                        help="slowest imported modules to show per module (default: 5)")
+    parser.add_argument("--budget", default=BUDGET_PATH)
+    return parser
+
+
+def import_times(module):
+    """Imports `module` in a new interpreter. Returns the cumulative time
+    of every imported module in microseconds, keyed by name, with the
+    measured module under its own name."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise ImportError(process.stderr.strip().splitlines()[-1])
+
+    times = {}
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def loaded_modules(module):
+    process = subprocess.run(
+        [sys.executable, "-c",
+         f"import json, sys, {module}; print(json.dumps(sorted(sys.modules)))"],
+        cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(process.stdout)
+
+
+def run(args):
+    with open(args.budget) as file:
+        budget = json.load(file)
+
+    failures = []
+    for module in args.modules or budget:
+        try:
+            runs = [import_times(module) for _ in range(args.runs)]
+        except ImportError as e:
+            print(f"{module}: cannot be imported ({e})")
+            failures.append(module)
+            continue
+
+        fastest = min(runs, key=lambda times: times[module])
+        milliseconds = fastest[module] / 1000
+        limit = budget.get(module)
+        over = limit is not None and milliseconds > limit
+        if over:
+            failures.append(module)
+        print(f"{module}: {milliseconds:.1f} ms"
+              + (f" (budget {limit} ms{', OVER' if over else ''})" if limit is not None else ""))
+
+        slowest = sorted(((time, name) for name, time in fastest.items()
+                          if name != module and "." not in name), reverse=True)
+        for time, name in slowest[:args.top]:
+            print(f"    {name}: {time / 1000:.1f} ms")
+
+    heavy = [name for name in loaded_modules("main")
+             if name.split(".")[0] in HEAVY_MODULES]
+    if heavy:
+        print(f"main imports heavy modules: {', '.join(sorted(heavy))}")
+        failures.append("main")
+
+    if failures:
+        print(f"Import time check failed: {', '.join(dict.fromkeys(failures))}")
+        sys.exit(1)
+    print("Import times are within budget.")
+
+
+if __name__ == "__main__":
+    run(get_parser().parse_args())
@@ -0,0 +1,205 @@
+"""
+Offline benchmark of the attendance pipeline.
+
+Runs the real clients against the fakes in `bench/fakes.py` and reports
+the wall time, API calls and peak memory of every phase:
+
+    python -m bench.run --courses 200 --students 40 --meetings 100
+    python -m bench.run --latency 50 --error-rate 0.01 --output bench.json
+
+Nothing leaves the machine; credentials, metadata and databases are
+created in a temporary directory.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+from package.classroom import ClassroomClient
+from package.client import set_http_factory
+from package.gmail import GmailClient
+from package.pipeline import drop_present, fill_missing_courses
+from package.salesforce import AttendanceClient
+
+from bench.fakes import Dataset, FakeGoogle, FakeSalesforceAdapter
+
+
+EXPIRY = "2099-01-01T00:00:00Z"
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Attendance Sheet Bot benchmark")
+    parser.add_argument("--courses", type=int, default=50)
+    parser.add_argument("--students", type=int, default=30,
+                        help="students per course")
+    parser.add_argument("--meetings", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="milliseconds added to every fake API call")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="fraction of fake API calls failing with a 503")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="do not trace memory (tracing slows the phases down)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the output of the clients")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    return parser
+
+
+def write_json(path, data):
+    with open(path, "w") as file:
+        file.write(json.dumps(data))
+
+
+def create_data_dir(path):
+    """Writes the files the clients expect in their data directory."""
+    secret = {"client_id": "bench.apps.googleusercontent.com",
+              "client_secret": "bench",
+              "token_uri": "https://oauth2.googleapis.com/token"}
+    google_token = dict(secret, token="bench", refresh_token="bench",
+                        expiry=EXPIRY, scopes=[])
+    gmail_token = dict(
+        secret,
+        _module="oauth2client.client",
+        _class="OAuth2Credentials",
+        access_token="bench",
+        refresh_token="bench",
+        token_expiry=EXPIRY,
+        user_agent=None,
+        revoke_uri="https://oauth2.googleapis.com/revoke",
+        id_token=None,
+        id_token_jwt=None,
+        token_response=None,
+        scopes=["https://www.googleapis.com/auth/gmail.modify"],
+        token_info_uri="https://oauth2.googleapis.com/tokeninfo",
+        invalid=False,
+    )
+
+    write_json(os.path.join(path, "secret.json"), {"installed": secret})
+    write_json(os.path.join(path, "credentials.json"),
+               dict(gmail_token, installed=secret,
+                    classroom=google_token, sheets=google_token))
+    write_json(os.path.join(path, "metadata.json"), {
+        "databaseLastUpdated": "01/01/2000",
+        "dataFrom": "01/01/2000",
+        "dataTill": "01/01/2000",
+    })
+    write_json(os.path.join(path, "salesforce_session.json"), {
+        "username": "bench", "session_id": "bench",
+        "instance": "bench.my.salesforce.com",
+    })
+
+
+class Phases:
+    """Measures phases: wall time, fake API calls and peak traced memory."""
+
+    def __init__(self, google, salesforce, trace_memory=True, verbose=False) -> None:
+        self.google = google
+        self.salesforce = salesforce
+        self.trace_memory = trace_memory
+        self.verbose = verbose
+        self.results = []
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        google_calls = Counter(self.google.calls)
+        salesforce_calls = sum(self.salesforce.calls.values())
+        if self.trace_memory:
+            tracemalloc.start()
+        output = contextlib.nullcontext() if self.verbose else \
+            contextlib.redirect_stdout(io.StringIO())
+        started = time.perf_counter()
+        try:
+            with output:
+                yield
+        finally:
+            wall_time = time.perf_counter() - started
+            peak = 0
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            calls = Counter(self.google.calls)
+            calls.subtract(google_calls)
+            calls["salesforce"] = sum(
+                self.salesforce.calls.values()) - salesforce_calls
+            self.results.append({
+                "phase": name,
+                "seconds": round(wall_time, 4),
+                "calls": {service: count for service, count in calls.items() if count},
+                "peak_memory_kb": round(peak / 1024),
+            })
+
+    def print_table(self):
+        print(f"{'phase':<18}{'seconds':>10}{'calls':>8}{'peak KiB':>10}  calls by service")
+        for result in self.results:
+            calls = result["calls"]
+            by_service = ", ".join(f"{service} {count}"
+                                   for service, count in sorted(calls.items()))
+            print(f"{result['phase']:<18}{result['seconds']:>10.3f}"
+                  f"{sum(calls.values()):>8}{result['peak_memory_kb']:>10}  {by_service}")
+
+
+def run(args):
+    dataset = Dataset(args.courses, args.students, args.meetings, seed=args.seed)
+    google = FakeGoogle(dataset, latency=args.latency / 1000,
+                        error_rate=args.error_rate, seed=args.seed)
+    salesforce = FakeSalesforceAdapter(latency=args.latency / 1000,
+                                       error_rate=args.error_rate, seed=args.seed)
+    phases = Phases(google, salesforce, not args.no_memory, args.verbose)
+    set_http_factory(google.http)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        create_data_dir(data_dir)
+        paths = {
+            "client_secret_path": os.path.join(data_dir, "secret.json"),
+            "credentials_path": os.path.join(data_dir, "credentials.json"),
+            "courses_path": os.path.join(data_dir, "courses.json"),
+            "database_path": os.path.join(data_dir, "attendance.db"),
+        }
+
+        cc = ClassroomClient(
+            metadata_path=os.path.join(data_dir, "metadata.json"),
+            students_path=os.path.join(data_dir, "students.json"),
+            **paths)
+        gc = GmailClient(
+            students_path=os.path.join(data_dir, "students.json"),
+            state_path=os.path.join(data_dir, "gmail_state.json"),
+            sheet_cache_path=os.path.join(data_dir, "sheet_cache.db"), **paths)
+        ac = AttendanceClient(
+            "bench", "bench", "bench",
+            session_path=os.path.join(data_dir, "salesforce_session.json"),
+            session=salesforce.session())
+
+        with phases.measure("generate_database"):
+            cc.generate_database(workers=args.workers,
+                                 requests_per_minute=10 ** 9)
+        with phases.measure("get_attendees"):
+            attendees = gc.get_attendees(workers=args.workers)
+        with phases.measure("get_absentees"):
+            absentees = cc.get_absentees(attendees)
+        with phases.measure("upload"):
+            fill_missing_courses(attendees, gc.course_index)
+            records = attendees + drop_present(absentees, attendees)
+            results = ac.upload_many(records)
+
+        cc.database.close()
+        gc.database.close()
+
+    print(f"{args.courses} courses, {args.students} students per course, "
+          f"{args.meetings} meetings: {len(attendees)} attendees, "
+          f"{len(records)} records, {sum(not r['success'] for r in results)} failed uploads")
+    phases.print_table()
+
+    if args.output:
+        write_json(args.output, {"parameters": vars(args), "phases": phases.results})
+
+
+if __name__ == "__main__":
+    run(get_parser().parse_args())
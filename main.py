@@ -1,13 +1,24 @@
 # create a python env with python 3.10 called attendance: 'python -m venv attendance'
 # activate python env: 'attendance\Scripts\activate'
 # install requirements: 'pip install -r requirements.txt'
-# run program: 'python main.py'
+# run program: 'python main.py' (see 'python main.py --help' for the options)
 
 # After creating and running for the first time, activate the env again and run the program.
 
-from package.gmail import GmailClient
-from package.salesforce import AttendanceClient
-from package.classroom import ClassroomClient
+import argparse
+import atexit
+import time
+import traceback
+from datetime import date
+
+from package.ledger import Ledger
+from package.lock import SingleFlightLock
+from package.metrics import metrics
+from package.rollup import Rollup
+
+# The clients and the pipeline import the Google and Salesforce libraries,
+# which take a while to load, so they are only imported by the runs that
+# use them (see bench/importtime.py).
 
 
 def get_env():
@@ -21,83 +32,349 @@ def get_env():
     return env_dict
 
 
+def get_parser():
+    parser = argparse.ArgumentParser(description="Attendance Sheet Bot")
+    parser.add_argument(
+        "--force-renew", action="store_true",
+        help="forcefully renew the API tokens")
+    parser.add_argument(
+        "--sync-db", action="store_true",
+        help="sync changed courses and students into the database before the run (resumable)")
+    parser.add_argument(
+        "--regenerate-db", action="store_true",
+        help="regenerate the students and courses database, then exit "
+             "(not recommended; takes a lot of time; cannot stop before completion)")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="only process meeting emails that arrived since the last incremental run")
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="upload every meeting as soon as its sheet is processed")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="finish uploading the records of the last run instead of starting a new one")
+    parser.add_argument(
+        "--release-bulk-job", metavar="JOB",
+        help="after checking a bulk job whose results could not be read, journal its "
+             "records again so --resume uploads them, then exit")
+    parser.add_argument(
+        "--external-id-field",
+        help="upsert records on this Salesforce external ID field instead of creating them")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="keep running, starting a cycle every --interval minutes")
+    parser.add_argument(
+        "--interval", type=float, default=10,
+        help="minutes between the starts of two daemon cycles (default: 10)")
+    parser.add_argument(
+        "--backfill", nargs=2, type=date.fromisoformat, metavar=("START", "END"),
+        help="upload the attendance of the meetings from START to END (YYYY-MM-DD, "
+             "both included), then exit; run again to resume a failed backfill")
+    parser.add_argument(
+        "--window-days", type=int, default=7,
+        help="days per backfill window (default: 7)")
+    parser.add_argument(
+        "--backfill-workers", type=int, default=4,
+        help="backfill windows processed in parallel (default: 4)")
+    parser.add_argument(
+        "--export-submissions", metavar="PATH",
+        help="export the coursework submissions of every course to PATH (JSON lines), "
+             "appending the ones changed since the last export, then exit")
+    parser.add_argument(
+        "--full-export", action="store_true",
+        help="rewrite the whole --export-submissions file")
+    parser.add_argument(
+        "--profiles",
+        help="run every account listed in this JSON file, each with its own data "
+             "directory, in parallel (supports --incremental and --resume)")
+    parser.add_argument(
+        "--processes", type=int,
+        help="worker processes for --profiles (default: one per CPU)")
+    parser.add_argument(
+        "--stats", nargs="+", metavar=("COURSE", "STUDENT"),
+        help="print the attendance statistics of a course (by ID, or code for courses "
+             "missing from the database), or of one of its students, then exit; "
+             "with --profiles, from the rollup of every account")
+    parser.add_argument(
+        "--push-rollup", metavar="SOBJECT",
+        help="after every run, upsert the attendance statistics changed since the "
+             "last push into this Salesforce object (needs --rollup-external-id)")
+    parser.add_argument(
+        "--rollup-external-id", metavar="FIELD",
+        help="external ID field of --push-rollup records, set to '<course>|<student>'")
+    traffic = parser.add_mutually_exclusive_group()
+    traffic.add_argument(
+        "--record", metavar="CASSETTE",
+        help="record the Google and Salesforce API traffic of the run to CASSETTE (.jsonl.gz)")
+    traffic.add_argument(
+        "--replay", metavar="CASSETTE",
+        help="replay a recorded run from CASSETTE without using the network; "
+             "run it on a copy of the data directory from before the recording")
+    parser.add_argument(
+        "--metrics",
+        help="write the API call metrics of every run to this file "
+             "(Prometheus text format if it ends with .prom, JSON otherwise)")
+    parser.add_argument(
+        "--profile",
+        help="profile every phase with cProfile into this directory")
+    return parser
+
+
+def get_gmail_client(args):
+    from package.gmail import GmailClient
+    return GmailClient(force_renew=args.force_renew)
+
+
+def get_classroom_client(args):
+    from package.classroom import ClassroomClient
+    return ClassroomClient(force_renew=args.force_renew)
+
+
+def get_salesforce_credentials():
+    env = get_env()
+    return (
+        env["SALESFORCE_USERNAME"],
+        env["SALESFORCE_PASSWORD"],
+        env["SALESFORCE_SECURITY_TOKEN"],
+    )
+
+
+def get_salesforce_client(session=None):
+    from package.salesforce import AttendanceClient
+    return AttendanceClient(*get_salesforce_credentials(), session=session)
+
+
+def report_metrics(args):
+    """Prints the API calls made today against the daily quotas, writes
+    the metrics file if asked, and starts counting a new run."""
+    usage = metrics.update_daily_usage()
+    print("API usage:")
+    for line in metrics.quota_report(usage):
+        print(f"  {line}")
+    if args.metrics:
+        metrics.write(args.metrics)
+    metrics.reset()
+
+
+def print_stats(rollup, args):
+    def line(stats):
+        days = stats["attended"] + stats["absent"]
+        return (f'{stats["first_name"] or ""} {stats["last_name"] or ""}: '
+                f'{stats["attended"]}/{days} days, {stats["minutes"]:g} min, '
+                f'{stats["first_seen"] or "-"} to {stats["last_seen"] or "-"}')
+
+    course = args.stats[0]
+    if len(args.stats) == 2:
+        stats = rollup.student(course, args.stats[1])
+        print(line(stats) if stats else f"No attendance of {args.stats[1]} in {course}.")
+        return
+    students = rollup.course(course)
+    if not students:
+        print(f"No attendance in {course}.")
+    for stats in students:
+        print(line(stats))
+
+
+def push_rollup(ac, rollup, args):
+    if not args.push_rollup:
+        return
+    print("Pushing the attendance statistics to salesforce...")
+    with metrics.phase("push_rollup"):
+        pushed = rollup.push(ac, args.push_rollup, args.rollup_external_id)
+    print(f"Pushed the statistics of {pushed} students.")
+
+
+def run_cycle(gc, cc, ac, ledger, rollup, args):
+    from package.pipeline import StreamingPipeline, run_phased, upload_records
+
+    # records an earlier run collected but did not upload are retried first
+    left = ledger.pending()
+    if left:
+        print(f"Retrying {len(left)} records left by the last run...")
+        with metrics.phase("upload"):
+            upload_records(ac, ledger, left, args.external_id_field)
+
+    if args.stream:
+        print("Streaming attendance to salesforce...")
+        pipeline = StreamingPipeline(
+            gc, cc, ac, ledger, external_id_field=args.external_id_field, rollup=rollup)
+        uploaded = pipeline.run(incremental=args.incremental)
+    else:
+        uploaded = run_phased(gc, cc, ac, ledger, args.incremental,
+                              args.external_id_field, rollup)
+
+    if not uploaded:
+        print("Some records failed to upload. Run again with --resume to retry them.")
+    push_rollup(ac, rollup, args)
+
+
+def run_daemon(gc, cc, ac, ledger, rollup, args, lock):
+    """Runs a cycle every `args.interval` minutes with the same clients.
+    A cycle is skipped if another run holds the lock."""
+    while True:
+        started = time.monotonic()
+        if lock.acquire():
+            try:
+                run_cycle(gc, cc, ac, ledger, rollup, args)
+            except Exception:
+                # a failed cycle should not stop the service; the records it
+                # journaled are retried by the next cycles (see run_cycle),
+                # and its messages are seen again as it did not commit them
+                traceback.print_exc()
+            finally:
+                lock.release()
+                report_metrics(args)
+        else:
+            print("Another run is in progress, skipping this cycle.")
+
+        time.sleep(max(0, args.interval * 60 - (time.monotonic() - started)))
+
+
 if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.profiles and (args.record or args.replay):
+        parser.error("--record and --replay cannot be used with --profiles")
+    if args.stats and len(args.stats) > 2:
+        parser.error("--stats takes a course and an optional student")
+    if args.push_rollup and not args.rollup_external_id:
+        parser.error("--push-rollup needs --rollup-external-id")
+
+    if args.stats:
+        if args.profiles:
+            from package.accounts import load_profiles
+
+            # the course is looked up in the rollup of every account
+            for profile in load_profiles(args.profiles):
+                print(f"[{profile.name}]")
+                print_stats(profile.rollup(), args)
+        else:
+            print_stats(Rollup(), args)
+        quit()
+
     print("Welcome To Attendence Sheet Bot")
 
-    force_renew = input(
-        "Forcefully renew the API tokens? (y/n) "
-    ).lower() == "y"
+    lock = SingleFlightLock()
+    if not args.daemon and not lock.acquire():
+        print("Another run is in progress.")
+        quit()
 
-    env = get_env()
+    metrics.profile_dir = args.profile
 
-    username = env["SALESFORCE_USERNAME"]
-    password = env["SALESFORCE_PASSWORD"]
-    security_token = env["SALESFORCE_SECURITY_TOKEN"]
+    session = None
+    if args.record or args.replay:
+        from package.cassette import Cassette
 
-    gc = GmailClient(force_renew=force_renew)
-    cc = ClassroomClient(force_renew=force_renew)
-    ac = AttendanceClient(username, password, security_token)
+        cassette = Cassette(args.record or args.replay,
+                            "record" if args.record else "replay")
+        session = cassette.install()
+        atexit.register(cassette.close)
 
-    regen_db = input("Do you wish to regenerate the students and courses database? (Not recommended; takes a lot of time; irreversible; cannot stop before completion) (y/n) ").lower() == "y"
+    if args.profiles:
+        from package.accounts import MultiAccountRunner, load_profiles
 
-    if regen_db:
+        profiles = load_profiles(args.profiles)
+        if args.release_bulk_job:
+            for profile in profiles:
+                ledger = profile.ledger()
+                released = ledger.release_unknown(args.release_bulk_job)
+                ledger.close()
+                print(f"[{profile.name}] Released {released} records of bulk job {args.release_bulk_job}.")
+            quit()
+        runner = MultiAccountRunner(
+            profiles,
+            get_salesforce_credentials(),
+            processes=args.processes,
+            external_id_field=args.external_id_field,
+            incremental=args.incremental,
+            force_renew=args.force_renew)
+        if not runner.run(resume=args.resume):
+            print("Some records failed to upload. Run again with --resume to retry them.")
+        if args.push_rollup:
+            ac = get_salesforce_client()
+            before = metrics.calls_by_service()
+            for profile in profiles:
+                print(f"[{profile.name}]")
+                push_rollup(ac, profile.rollup(), args)
+            # the Salesforce usage is shared by the accounts, see upload_records
+            calls = metrics.calls_by_service()
+            calls.subtract(before)
+            metrics.update_daily_usage(calls=+calls)
+        # the daily usage is kept per account by the runner
+        if args.metrics:
+            metrics.write(args.metrics)
+        quit()
+
+    ledger = Ledger()
+    rollup = Rollup()
+
+    if args.release_bulk_job:
+        released = ledger.release_unknown(args.release_bulk_job)
+        print(f"Released {released} records of bulk job {args.release_bulk_job}. "
+              "Run again with --resume to upload them.")
+        quit()
+
+    if args.resume:
+        from package.pipeline import upload_records
+
+        ac = get_salesforce_client(session)
+        records = ledger.pending()
+        print(f"Resuming the last run ({len(records)} records left).")
+        with metrics.phase("upload"):
+            uploaded = upload_records(
+                ac, ledger, records, args.external_id_field)
+        if not uploaded:
+            print("Some records failed to upload. Run again with --resume to retry them.")
+        report_metrics(args)
+        quit()
 
-        if input("Do you wish to continue? (y/n)").lower() == "y":
-            print("Generating the database...")
+    if args.regenerate_db:
+        cc = get_classroom_client(args)
+        print("Generating the database...")
+        with metrics.phase("generate_database"):
             cc.generate_database()
-            print("Database regenerated successfully.")
-            quit()
+        print("Database regenerated successfully.")
+        report_metrics(args)
+        quit()
 
-    print("Getting attendees...")
-    attendees = gc.get_attendees()
-    print("Getting absentees...")
-    absentees = cc.get_absentees(attendees)
+    if args.export_submissions:
+        cc = get_classroom_client(args)
+        print("Exporting submissions...")
+        with metrics.phase("export_submissions"):
+            cc.export_submissions(args.export_submissions, full=args.full_export)
+        report_metrics(args)
+        quit()
 
-    missing_courses = []
+    gc = get_gmail_client(args)
+    cc = get_classroom_client(args)
+    ac = get_salesforce_client(session)
 
-    for attendee in attendees:
-        if attendee["Course"] == None:
-            course_code = ""
-            try:
-                name_code = "-".join([x for x in attendee["Last name"][::-1].split("-")
-                                      if x[0] not in "abcdefghijklmnopqrstuvwxyz "])[::-1].strip()
-                attrs = name_code.split("-")
-                attrs.pop(3)
-                course_code = "-".join(attrs)
-            except IndexError:
-                pass
-            if not course_code:
-                course_code = None
-            missing_courses.append(course_code)
-            attendee["Course"] = course_code
-
-    print(f"Missing courses: {list(set(missing_courses))}")
-    print("This may be due to these courses being older than or newer than the database\ngeneration period. ")
-    print("Auto setting them to course code extracted from attendee names.")
-
-    print()
-
-    print("Uploading to salesforce...")
-
-    for attendee in attendees:
-        ac.upload(attendee)
-        print(
-            f'Uploaded attendance for {attendee["Last name"]} (Course: {attendee["Course"]})'
-        )
-
-    # Create a set of unique keys for attendees using Course ID, Last name, and Date
-    attendees_set = {
-        (attendee["Course ID"], attendee["Last name"].strip(), attendee["Date"])
-        for attendee in attendees
-    }
-
-    for absentee in absentees:
-        # Create a key for each absentee
-        absentee_key = (absentee["Course ID"],
-                        absentee["Last name"].strip(), absentee["Date"])
-
-        # Check if this absentee is not in the attendees set
-        if absentee_key not in attendees_set:
-            ac.upload(absentee)
-            print(
-                f'Uploaded absence for {absentee["Last name"]} (Course: {absentee["Course"]})')
+    if args.sync_db:
+        print("Syncing the database...")
+        with metrics.phase("sync_database"):
+            cc.sync_database()
+        print("Database synced successfully.")
+
+    if args.backfill:
+        from package.backfill import Backfill
+
+        backfill = Backfill(
+            gc, cc, ac, ledger,
+            window_days=args.window_days,
+            workers=args.backfill_workers,
+            external_id_field=args.external_id_field,
+            rollup=rollup)
+        with metrics.phase("backfill"):
+            completed = backfill.run(*args.backfill)
+        if not completed:
+            print("Some windows failed. Run the same backfill again to retry them.")
+        push_rollup(ac, rollup, args)
+        report_metrics(args)
+        quit()
+
+    if args.daemon:
+        print(f"Running every {args.interval:g} minutes. Press Ctrl+C to stop.")
+        run_daemon(gc, cc, ac, ledger, rollup, args, lock)
+    else:
+        run_cycle(gc, cc, ac, ledger, rollup, args)
+        report_metrics(args)
@@ -0,0 +1,311 @@
+import json
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .ledger import Ledger
+from .metrics import metrics
+from .records import COLLECTION_SIZE
+
+
+class Profile:
+    """
+    An instructor/Workspace account. Its credentials, tokens, databases,
+    state and quota files live in `data_dir`, laid out like the default
+    data/ directory.
+    """
+
+    def __init__(self, name, data_dir) -> None:
+        self.name = name
+        self.data_dir = data_dir
+
+    def path(self, filename):
+        return os.path.join(self.data_dir, filename)
+
+    def gmail_client(self, force_renew=False):
+        from .gmail import GmailClient
+        return GmailClient(
+            client_secret_path=self.path("secret.json"),
+            credentials_path=self.path("credentials.json"),
+            courses_path=self.path("courses.json"),
+            students_path=self.path("students.json"),
+            database_path=self.path("attendance.db"),
+            state_path=self.path("gmail_state.json"),
+            sheet_cache_path=self.path("sheet_cache.db"),
+            token_path=self.path("gmail_token.json"),
+            force_renew=force_renew,
+        )
+
+    def classroom_client(self, force_renew=False):
+        from .classroom import ClassroomClient
+        return ClassroomClient(
+            metadata_path=self.path("metadata.json"),
+            client_secret_path=self.path("secret.json"),
+            credentials_path=self.path("credentials.json"),
+            courses_path=self.path("courses.json"),
+            students_path=self.path("students.json"),
+            database_path=self.path("attendance.db"),
+            force_renew=force_renew,
+        )
+
+    def ledger(self):
+        return Ledger(self.path("ledger.db"))
+
+    def rollup(self):
+        from .rollup import Rollup
+        return Rollup(self.path("rollup.db"))
+
+    def backfill(self, gc, cc, ac, **kwargs):
+        from .backfill import Backfill
+        return Backfill(gc, cc, ac, self.ledger(), checkpoint_path=self.path("backfill.json"),
+                        rollup=self.rollup(), **kwargs)
+
+    def update_daily_usage(self, calls=None):
+        """Adds the Google API calls of the account to its daily usage and
+        prints what is left of its quotas."""
+        usage = metrics.update_daily_usage(self.path("quota_usage.json"), calls)
+        for line in metrics.quota_report(usage, self.path("quotas.json")):
+            print(f"[{self.name}] {line}")
+
+
+def load_profiles(path="data/profiles.json"):
+    """
+    Reads the account profiles, a list like
+    [{"name": "instructor1", "data_dir": "data/instructor1"}, ...].
+    `data_dir` defaults to data/<name>.
+    """
+    with open(path) as file:
+        return [
+            Profile(profile["name"], profile.get(
+                "data_dir", os.path.join("data", profile["name"])))
+            for profile in json.load(file)
+        ]
+
+
+def collect_records(profile: Profile, queue, incremental=False, force_renew=False):
+    """
+    Collects the attendees and absentees of one account, counts them in its
+    rollup and sends them to the uploader through `queue` as (profile name,
+    records). Runs in a worker process.
+
+    The messages are not marked as read, nor the history committed: that
+    is left to `MultiAccountRunner` once the uploader has uploaded every
+    record. Returns {"records": number of records, "read": message IDs,
+    "history_id": history ID reached, "skipped": IDs of the messages
+    skipped (see `GmailClient.iter_meetings`), "metrics": `metrics.snapshot()`}.
+    """
+    from .pipeline import drop_present, fill_missing_courses
+
+    # a pool process runs several accounts one after the other
+    metrics.reset()
+    print(f"[{profile.name}] Collecting attendance...")
+    gc = profile.gmail_client(force_renew)
+    cc = profile.classroom_client(force_renew)
+    with metrics.phase("get_attendees"):
+        attendees = gc.get_attendees(incremental=incremental)
+    with metrics.phase("get_absentees"):
+        absentees = cc.get_absentees(attendees)
+    fill_missing_courses(attendees, gc.course_index)
+
+    records = attendees + drop_present(absentees, attendees)
+    rollup = profile.rollup()
+    rollup.add(records)
+    rollup.close()
+
+    records = [record.as_dict() for record in records]
+    for start in range(0, len(records), COLLECTION_SIZE):
+        queue.put((profile.name, records[start:start + COLLECTION_SIZE]))
+    print(f"[{profile.name}] Collected {len(records)} records.")
+    profile.update_daily_usage()
+    return {
+        "records": len(records),
+        "read": gc.processed_ids,
+        "history_id": gc.new_history_id,
+        "skipped": gc.skipped_ids,
+        "metrics": metrics.snapshot(),
+    }
+
+
+def upload_records(queue, results, profiles, salesforce_credentials,
+                   batch_size=COLLECTION_SIZE, external_id_field=None):
+    """
+    The shared uploader: uploads the records of every account as they
+    arrive on `queue`, in batches that mix accounts, until it receives
+    None. Each account's records are checked against and recorded in its
+    own ledger. Puts ({profile name: (uploaded, failed)},
+    `metrics.snapshot()`) on `results`. Runs in its own process.
+    """
+    from .pipeline import report_results
+    from .salesforce import AttendanceClient
+
+    metrics.reset()
+    ac = AttendanceClient(*salesforce_credentials)
+    ledgers = {profile.name: profile.ledger() for profile in profiles}
+    counts = {profile.name: [0, 0] for profile in profiles}
+    for ledger in ledgers.values():
+        ledger.begin()
+
+    def send(pairs):
+        batch = [record for _, record in pairs]
+        owners = {id(record): name for name, record in pairs}
+
+        def callback(sent, sent_results):
+            by_owner = {}
+            for record, result in zip(sent, sent_results):
+                records, owner_results = by_owner.setdefault(
+                    owners[id(record)], ([], []))
+                records.append(record)
+                owner_results.append(result)
+            for name, (records, owner_results) in by_owner.items():
+                ledgers[name].add(records, owner_results)
+                for result in owner_results:
+                    counts[name][0 if result["success"] else 1] += 1
+
+        results = ac.upload_many(
+            batch,
+            batch_size=batch_size,
+            external_id_field=external_id_field,
+            external_id=Ledger.external_id,
+            callback=callback,
+        )
+        report_results(batch, results)
+
+    # (profile name, record) pairs waiting for a full batch
+    pending = []
+    with metrics.phase("upload"):
+        while (item := queue.get()) is not None:
+            name, records = item
+            records = ledgers[name].filter_new(records)
+            ledgers[name].append(records)
+            pending.extend((name, record) for record in records)
+            while len(pending) >= batch_size:
+                send(pending[:batch_size])
+                pending = pending[batch_size:]
+        if pending:
+            send(pending)
+
+    for name, ledger in ledgers.items():
+        if not counts[name][1]:
+            ledger.finish()
+        ledger.close()
+
+    # the Salesforce org is shared by the accounts, so is its usage file
+    usage = metrics.update_daily_usage()
+    for line in metrics.quota_report(usage):
+        print(f"[uploader] {line}")
+    results.put(({name: tuple(count) for name, count in counts.items()},
+                 metrics.snapshot()))
+
+
+class MultiAccountRunner:
+    """
+    Runs several accounts at once. The accounts are sharded across a pool
+    of `processes` worker processes, each collecting the attendance of one
+    account at a time, and a single uploader process batches the records
+    of all of them into Salesforce requests.
+
+    The messages of an account are marked as read, and its Gmail history
+    committed, only once the uploader has uploaded all of its records.
+    The metrics of every process are merged into `metrics`.
+    """
+
+    def __init__(self, profiles, salesforce_credentials, processes=None, batch_size=COLLECTION_SIZE,
+                 external_id_field=None, incremental=False, force_renew=False) -> None:
+        self.profiles = profiles
+        self.salesforce_credentials = salesforce_credentials
+        self.processes = processes or os.cpu_count()
+        self.batch_size = batch_size
+        self.external_id_field = external_id_field
+        self.incremental = incremental
+        self.force_renew = force_renew
+
+    def run(self, resume=False):
+        """
+        Returns True if every record of every account was uploaded. If
+        `resume` is set, the records left by the last run of every account
+        are uploaded instead of collecting new ones.
+        """
+        if resume:
+            left = {}
+            for profile in self.profiles:
+                ledger = profile.ledger()
+                left[profile.name] = ledger.pending()
+                ledger.close()
+
+        with multiprocessing.Manager() as manager:
+            queue = manager.Queue()
+            results = manager.Queue()
+            uploader = multiprocessing.Process(
+                target=upload_records,
+                args=(queue, results, self.profiles, self.salesforce_credentials,
+                      self.batch_size, self.external_id_field))
+            uploader.start()
+
+            failed_accounts = []
+            # profile name -> what `collect_records` returned
+            collected = {}
+            try:
+                if resume:
+                    for name, records in left.items():
+                        print(f"[{name}] Resuming the last run ({len(records)} records left).")
+                        for start in range(0, len(records), COLLECTION_SIZE):
+                            queue.put((name, records[start:start + COLLECTION_SIZE]))
+                    return self.__finish(uploader, queue, results, failed_accounts, collected)
+
+                with ProcessPoolExecutor(max_workers=max(1, min(self.processes, len(self.profiles)))) as executor:
+                    futures = {
+                        executor.submit(collect_records, profile, queue,
+                                        self.incremental, self.force_renew): profile
+                        for profile in self.profiles
+                    }
+                    for future in as_completed(futures):
+                        name = futures[future].name
+                        try:
+                            collected[name] = future.result()
+                        except Exception:
+                            traceback.print_exc()
+                            failed_accounts.append(name)
+                            continue
+                        metrics.merge(collected[name].pop("metrics"))
+            except BaseException:
+                queue.put(None)
+                uploader.join()
+                raise
+            return self.__finish(uploader, queue, results, failed_accounts, collected)
+
+    def __finish(self, uploader, queue, results, failed_accounts, collected):
+        queue.put(None)
+        uploader.join()
+        if uploader.exitcode != 0:
+            # nothing is committed, so the next run sees the messages again
+            print("The uploader failed. Run again with --resume to retry.")
+            return False
+
+        counts, snapshot = results.get()
+        metrics.merge(snapshot)
+        for name, (uploaded, failed) in counts.items():
+            status = "failed to collect, " if name in failed_accounts else ""
+            print(f"[{name}] {status}{uploaded} uploaded, {failed} failed")
+
+        committed = True
+        for profile in self.profiles:
+            if profile.name in collected and not counts[profile.name][1]:
+                try:
+                    self.__commit(profile, collected[profile.name])
+                except Exception:
+                    traceback.print_exc()
+                    committed = False
+        return committed and not failed_accounts and not any(failed for _, failed in counts.values())
+
+    def __commit(self, profile, collected):
+        # Marks the messages of an account as read and commits its history,
+        # once every record it collected was uploaded.
+        before = metrics.calls_by_service()
+        with metrics.phase("commit"):
+            gc = profile.gmail_client()
+            gc.mark_as_read(collected["read"])
+            if self.incremental:
+                gc.commit_history(collected["history_id"], collected["skipped"])
+        calls = metrics.calls_by_service()
+        calls.subtract(before)
+        metrics.update_daily_usage(profile.path("quota_usage.json"), +calls)
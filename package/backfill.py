@@ -0,0 +1,141 @@
+import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+from .pipeline import drop_present, fill_missing_courses, report_results
+from .ratelimit import RateLimiter
+
+
+def date_windows(start: date, end: date, days=7):
+    """Splits the dates from `start` to `end` (both included) into windows
+    of `days` days. Returns (first day, day after the last) pairs."""
+    windows = []
+    while start <= end:
+        before = min(start + timedelta(days=days), end + timedelta(days=1))
+        windows.append((start, before))
+        start = before
+    return windows
+
+
+class Backfill:
+    """
+    Reconstructs the attendance of a past date range. The range is split
+    into windows of `window_days` days, and `workers` windows are processed
+    in parallel, each listing its meeting emails, downloading their sheets
+    and uploading the records the ledger does not have yet. Gmail and
+    Sheets requests of every window share one rate limit of
+    `requests_per_minute`; uploads are made one window at a time.
+
+    Every window that was uploaded completely is checkpointed, so a
+    backfill that failed halfway is resumed by running it again. The
+    records of every window are counted in `rollup`, if given.
+    """
+
+    def __init__(self, gc, cc, ac, ledger, checkpoint_path="data/backfill.json", window_days=7,
+                 workers=4, sheet_workers=4, requests_per_minute=600, external_id_field=None,
+                 rollup=None) -> None:
+        self.gc = gc
+        self.cc = cc
+        self.ac = ac
+        self.ledger = ledger
+        self.checkpoint_path = checkpoint_path
+        self.window_days = window_days
+        self.workers = workers
+        self.sheet_workers = sheet_workers
+        self.requests_per_minute = requests_per_minute
+        self.external_id_field = external_id_field
+        self.rollup = rollup
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def window_key(window):
+        after, before = window
+        return f"{after.isoformat()}/{before.isoformat()}"
+
+    def __load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as file:
+                return set(json.load(file).get("done", []))
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return set()
+
+    def __save_checkpoint(self, done):
+        with open(self.checkpoint_path, "w") as file:
+            file.write(json.dumps({"done": sorted(done)}))
+
+    def run(self, start: date, end: date):
+        """Backfills the dates from `start` to `end` (both included).
+        Returns True if every window was uploaded completely."""
+        done = self.__load_checkpoint()
+        windows = [window for window in date_windows(start, end, self.window_days)
+                   if self.window_key(window) not in done]
+        if not windows:
+            print("Every window of the range was already backfilled.")
+            return True
+        print(f"Backfilling {len(windows)} windows of up to {self.window_days} days...")
+
+        self.gc.rate_limiter = RateLimiter(self.requests_per_minute)
+        failed = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(self.__process, window): window
+                           for window in windows}
+                for future in as_completed(futures):
+                    key = self.window_key(futures[future])
+                    try:
+                        uploaded = future.result()
+                    except Exception:
+                        traceback.print_exc()
+                        uploaded = False
+                    if uploaded:
+                        done.add(key)
+                        self.__save_checkpoint(done)
+                        print(f"Backfilled {key}")
+                    else:
+                        failed += 1
+                        print(f"Failed to backfill {key}, it will be retried on the next run.")
+        finally:
+            self.gc.rate_limiter = None
+
+        return failed == 0
+
+    def __process(self, window):
+        # Gmail connections are not thread-safe, so every window thread
+        # makes its requests on its own.
+        if not hasattr(self.__local, "http"):
+            self.__local.http = self.gc.authorized_http()
+        http = self.__local.http
+
+        after, before = window
+        query = self.gc.window_query(
+            after.strftime("%Y/%m/%d"), before.strftime("%Y/%m/%d"))
+
+        attendees = []
+        read = []
+        skipped = []
+        for message, _, meeting_attendees in self.gc.iter_meetings(
+                self.sheet_workers, query=query, http=http, skipped=skipped):
+            attendees.extend(meeting_attendees)
+            read.append(message.id)
+
+        absentees = self.cc.get_absentees(attendees)
+        fill_missing_courses(attendees, self.gc.course_index)
+        records = attendees + drop_present(absentees, attendees)
+        if self.rollup is not None:
+            self.rollup.add(records)
+        records = self.ledger.filter_new(records)
+
+        with self.__lock:
+            results = self.ac.upload_many(
+                records,
+                external_id_field=self.external_id_field,
+                external_id=self.ledger.external_id,
+                callback=self.ledger.add,
+            )
+            report_results(records, results)
+
+        self.gc.mark_as_read(read, http=http)
+        # a window with messages or sheets that could not be fetched is run again
+        return not skipped and all(result["success"] for result in results)
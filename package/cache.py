@@ -0,0 +1,83 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheets (
+    spreadsheet_id TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    content BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (spreadsheet_id, revision)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sheets_last_used ON sheets (last_used);
+"""
+
+
+class SheetCache:
+    """
+    On-disk cache of parsed spreadsheets (as returned by
+    `SheetsClient.get_spreadsheet`), keyed by spreadsheet ID and revision.
+
+    Meet attendance sheets do not change once the meeting records email is
+    sent, so a sheet fetched once is served from here when its email is
+    processed again. Contents are stored compressed, and the least
+    recently used sheets are evicted once the cache is over `max_bytes`.
+    """
+
+    def __init__(self, path="data/sheet_cache.db", max_bytes=64 * 1024 * 1024) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.__lock = threading.RLock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__connection:
+            self.__connection.executescript(SCHEMA)
+
+    def close(self):
+        self.__connection.close()
+
+    def get(self, spreadsheet_id, revision=""):
+        """Returns the cached spreadsheet, or None."""
+        with self.__lock, self.__connection:
+            row = self.__connection.execute(
+                "SELECT content FROM sheets WHERE spreadsheet_id = ? AND revision = ?",
+                (spreadsheet_id, revision)
+            ).fetchone()
+            if row is None:
+                return None
+            self.__connection.execute(
+                "UPDATE sheets SET last_used = ? WHERE spreadsheet_id = ? AND revision = ?",
+                (time.time(), spreadsheet_id, revision)
+            )
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, spreadsheet_id, spreadsheet, revision=""):
+        content = zlib.compress(json.dumps(spreadsheet).encode())
+        with self.__lock, self.__connection:
+            # older revisions of the sheet will not be asked for again
+            self.__connection.execute(
+                "DELETE FROM sheets WHERE spreadsheet_id = ?", (spreadsheet_id,))
+            self.__connection.execute(
+                "INSERT INTO sheets VALUES (?, ?, ?, ?, ?)",
+                (spreadsheet_id, revision, content, len(content), time.time())
+            )
+            self.__evict()
+
+    def __evict(self):
+        total = self.__connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM sheets").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for spreadsheet_id, revision, size in self.__connection.execute(
+                "SELECT spreadsheet_id, revision, size FROM sheets ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((spreadsheet_id, revision))
+            total -= size
+        self.__connection.executemany(
+            "DELETE FROM sheets WHERE spreadsheet_id = ? AND revision = ?", evicted)
@@ -0,0 +1,189 @@
+import base64
+import gzip
+import json
+import re
+import threading
+from collections import deque
+
+import httplib2
+import requests
+from googleapiclient.http import build_http
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+from .client import set_http_factory
+
+
+BATCH_REQUEST_ID = re.compile(r"Content-ID: <([^+>]+)\+")
+BATCH_RESPONSE_ID = re.compile(r"Content-ID: <response-([^+>]+)\+")
+
+
+class Cassette:
+    """
+    Records the Google and Salesforce API traffic of a run to a gzipped
+    JSON lines file, or replays it without touching the network.
+
+    In record mode, every response received by the Google clients (through
+    `set_http_factory`) and by the Salesforce session is appended to
+    `path`. In replay mode, requests are answered with the recorded
+    responses, matched by method and URL in the order they were recorded,
+    so a run is repeated exactly, at full speed, with no email marked as
+    read and no record created. Local state (the ledger, the Gmail history
+    ID, the databases) is not part of the cassette: replay against a copy
+    of the data directory taken before the recorded run. Replays use the
+    stored tokens even once they expired, so they can be repeated later.
+    """
+
+    def __init__(self, path, mode="record") -> None:
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.__lock = threading.Lock()
+        self.__file = None
+        self.__responses = {}
+
+        if mode == "record":
+            self.__file = gzip.open(path, "wt", encoding="utf-8")
+        else:
+            with gzip.open(path, "rt", encoding="utf-8") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self.__responses.setdefault(
+                        (entry["method"], entry["uri"]), deque()).append(entry)
+
+    def install(self):
+        """Routes the Google clients created afterwards through the cassette.
+        Returns the requests session to give to `AttendanceClient`."""
+        set_http_factory(self.google_http, replaying=self.mode == "replay")
+        return self.salesforce_session()
+
+    def google_http(self):
+        if self.mode == "record":
+            return RecordingHttp(build_http(), self)
+        return ReplayHttp(self)
+
+    def salesforce_session(self):
+        session = requests.Session()
+        adapter = RecordingAdapter(self) if self.mode == "record" else ReplayAdapter(self)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def record(self, method, uri, status, headers, content):
+        entry = {
+            "method": method,
+            "uri": uri,
+            "status": status,
+            "headers": {key: value for key, value in headers.items()
+                        if key.lower() not in ("status", "set-cookie")},
+            "body": base64.b64encode(content or b"").decode(),
+        }
+        with self.__lock:
+            self.__file.write(json.dumps(entry) + "\n")
+            self.__file.flush()
+
+    def replay(self, method, uri, request_body=None):
+        """Returns (status, headers, content) of the next recorded response
+        to `method` `uri`."""
+        with self.__lock:
+            try:
+                entry = self.__responses[(method, uri)].popleft()
+            except (KeyError, IndexError):
+                raise LookupError(
+                    f"No recorded response left for {method} {uri}") from None
+
+        content = base64.b64decode(entry["body"])
+        if "/batch" in uri.split("?")[0]:
+            content = self.__rebase_batch(content, request_body)
+        return entry["status"], entry["headers"], content
+
+    @staticmethod
+    def __rebase_batch(content, request_body):
+        # The parts of a batch response are matched to the requests by a
+        # random ID generated for every batch, so the recorded IDs are
+        # replaced with the ones of the replayed request.
+        if isinstance(request_body, bytes):
+            request_body = request_body.decode("utf-8", "replace")
+        new_id = BATCH_REQUEST_ID.search(request_body or "")
+        text = content.decode("utf-8")
+        old_id = BATCH_RESPONSE_ID.search(text)
+        if not (new_id and old_id):
+            return content
+        return text.replace(f"<response-{old_id.group(1)}+",
+                            f"<response-{new_id.group(1)}+").encode("utf-8")
+
+    def close(self):
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+
+class RecordingHttp:
+    """httplib2 connection that records every response in a cassette."""
+
+    def __init__(self, http, cassette: Cassette) -> None:
+        self.http = http
+        self.cassette = cassette
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        response, content = self.http.request(
+            uri, method, body, headers, *args, **kwargs)
+        self.cassette.record(method, uri, response.status, dict(response), content)
+        return response, content
+
+
+class ReplayHttp:
+    """httplib2 connection answering with the responses of a cassette."""
+
+    def __init__(self, cassette: Cassette) -> None:
+        self.cassette = cassette
+        self.timeout = None
+        self.redirect_codes = set()
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        status, headers, content = self.cassette.replay(method, uri, body)
+        return httplib2.Response(dict(headers, status=str(status))), content
+
+    def close(self):
+        pass
+
+
+class RecordingAdapter(HTTPAdapter):
+    """requests transport adapter that records every response in a cassette."""
+
+    def __init__(self, cassette: Cassette) -> None:
+        super().__init__()
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        self.cassette.record(request.method, request.url, response.status_code,
+                             dict(response.headers), response.content)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """requests transport adapter answering with the responses of a cassette."""
+
+    def __init__(self, cassette: Cassette) -> None:
+        super().__init__()
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        status, headers, content = self.cassette.replay(request.method, request.url)
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        # the recorded body is already decoded
+        response.headers.pop("Content-Encoding", None)
+        response._content = content
+        response.request = request
+        response.url = request.url
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+    def close(self):
+        pass
@@ -1,9 +1,28 @@
 import json
-from datetime import datetime, timezone
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 from .client import BaseClient
+from .index import RosterIndex
+from .ratelimit import RateLimiter
+from .records import Absentee
+from .store import Database
+
+
+# The Classroom API caps the page size server-side,
+# so asking for more than it allows is harmless.
+MAX_PAGE_SIZE = 1000
+
+# The parts of a student submission kept by `export_submissions`.
+SUBMISSION_FIELDS = (
+    "nextPageToken,studentSubmissions(id,courseId,courseWorkId,userId,state,late,"
+    "assignedGrade,draftGrade,courseWorkType,creationTime,updateTime)"
+)
 
 
 class Student:
+    __slots__ = ("course_id", "full_name")
 
     def __init__(self, student) -> None:
         try:
@@ -23,6 +42,9 @@ class Student:
 
 
 class Course:
+    __slots__ = ("name", "id", "link", "description", "room",
+                 "meet_link", "time_created", "time_updated")
+
     def __init__(self, course) -> None:
         self.name = course["name"]
         self.id = course["id"]
@@ -37,6 +59,7 @@ class Course:
             self.room = None
         self.meet_link = self.room
         self.time_created = course["creationTime"]
+        self.time_updated = course.get("updateTime")
 
     def as_dict(self):
         course_dict = {
@@ -46,6 +69,7 @@ class Course:
             "description": self.description,
             "meet_link": self.meet_link,
             "time_created": self.time_created,
+            "time_updated": self.time_updated,
         }
         return course_dict
 
@@ -58,6 +82,7 @@ class ClassroomClient(BaseClient):
             credentials_path="data/credentials.json",
             courses_path="data/courses.json",
             students_path="data/students.json",
+            database_path="data/attendance.db",
             force_renew=False
     ) -> None:
         super().__init__(
@@ -79,6 +104,8 @@ class ClassroomClient(BaseClient):
         self.data_from = self.metadata["dataFrom"]
         self.data_till = self.metadata["dataTill"]
         self.students_path = students_path
+        self.database = Database(database_path, courses_path, students_path)
+        self.rate_limiter = None
 
     def __get_todays_date(self):
         # Get today's date
@@ -104,72 +131,238 @@ class ClassroomClient(BaseClient):
 
         return iso_date > from_date
 
-    def get_courses(self):
+    def get_courses(self, all_pages=False):
+        """
+        Lists the courses, newest first. Unless `all_pages` is set, paging
+        stops once the courses are older than the last database generation.
+        """
         courses: list[Course] = []
-        results = self.service.courses().list(pageSize=10, pageToken=None).execute()
+        results = self.execute(self.service.courses().list(
+            pageSize=MAX_PAGE_SIZE, pageToken=None))
         next_token = results.get("nextPageToken")
         for course in results.get("courses", []):
             courses.append(Course(course))
 
         if courses:
-            while next_token and self.is_since_start_date(courses[-1].time_created):
-                results = self.service.courses().list(
-                    pageSize=10, pageToken=next_token).execute()
+            while next_token and (all_pages or self.is_since_start_date(courses[-1].time_created)):
+                results = self.execute(self.service.courses().list(
+                    pageSize=MAX_PAGE_SIZE, pageToken=next_token))
                 next_token = results.get("nextPageToken")
                 for course in results.get("courses", []):
                     courses.append(Course(course))
 
         return courses
 
-    def get_students(self, courseId):
+    def get_students(self, courseId, http=None):
         # implement and save in new data.json and ask in init whether or reload the db or not
         students: list[Student] = []
-        results = self.service.courses().students().list(
-            courseId=courseId, pageSize=10, pageToken=None).execute()
-        next_token = results.get("nextPageToken")
-        for student in results.get("students", []):
-            students.append(Student(student))
-
-        if students:
-            while next_token:
-                results = self.service.courses().students().list(
-                    courseId=courseId, pageSize=10, pageToken=next_token).execute()
-                next_token = results.get("nextPageToken")
-                for student in results.get("students", []):
-                    students.append(Student(student))
+        next_token = None
+
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.wait()
+            results = self.execute(self.service.courses().students().list(
+                courseId=courseId, pageSize=MAX_PAGE_SIZE, pageToken=next_token), http=http)
+            next_token = results.get("nextPageToken")
+            for student in results.get("students", []):
+                students.append(Student(student))
+            if not (students and next_token):
+                break
 
         return students
 
+    def __fetch_all(self, fetch, items, workers):
+        # Runs fetch(item, http) for every item on a pool of `workers`
+        # threads, each with its own HTTP connection, and yields
+        # (item, result) as the results arrive.
+        local = threading.local()
+
+        def run(item):
+            if not hasattr(local, "http"):
+                local.http = self.authorized_http()
+            return item, fetch(item, local.http)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run, item) for item in items]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def fetch_rosters(self, courses: list[Course], workers=8):
+        """
+        Fetches the students of every course on a pool of `workers` threads,
+        each with its own HTTP connection. Yields (course, students) as the
+        rosters arrive.
+        """
+        yield from self.__fetch_all(
+            lambda course, http: self.get_students(course.id, http=http),
+            courses, workers)
+
+    def get_submissions(self, courseId, http=None, fields=SUBMISSION_FIELDS):
+        """Returns the student submissions of every coursework of a course."""
+        submissions = []
+        next_token = None
+
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.wait()
+            results = self.execute(self.service.courses().courseWork().studentSubmissions().list(
+                courseId=courseId, courseWorkId="-", pageSize=MAX_PAGE_SIZE,
+                pageToken=next_token, fields=fields), http=http)
+            submissions.extend(results.get("studentSubmissions", []))
+            next_token = results.get("nextPageToken")
+            if not next_token:
+                break
+
+        return submissions
+
+    @staticmethod
+    def __time_key(timestamp):
+        # RFC 3339 timestamps with any number of fractional digits, as
+        # strings that sort in time order
+        base, _, fraction = (timestamp or "").rstrip("Z").partition(".")
+        return f"{base}.{fraction.ljust(9, '0')}" if base else ""
+
+    def __load_export_state(self, state_path):
+        try:
+            with open(state_path) as file:
+                return json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}
+
+    def export_submissions(self, path="data/submissions.jsonl", course_ids=None, full=False,
+                           state_path="data/submissions_state.json", workers=8, requests_per_minute=600):
+        """
+        Exports the student submissions of the courses (every course in the
+        database by default) to `path`, one JSON object per line. Courses are
+        fetched concurrently by `workers` threads, together making at most
+        `requests_per_minute` calls, and written as they arrive.
+
+        The Classroom API cannot filter submissions by time, so after the
+        first export only the submissions whose `updateTime` is newer than
+        the last one exported for their course are appended; the latest
+        line of a submission ID is its current state. `full` rewrites the
+        file with every submission. The newest `updateTime` of every course
+        is checkpointed in `state_path` as soon as the course is written.
+        """
+        if course_ids is None:
+            course_ids = list(self.database.get_courses())
+        state = {} if full else self.__load_export_state(state_path)
+        if not os.path.exists(path):
+            state = {}
+        exported = 0
+
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        try:
+            with open(path, "w" if not state else "a") as file:
+                for course_id, submissions in self.__fetch_all(
+                        lambda course_id, http: self.get_submissions(course_id, http=http),
+                        course_ids, workers):
+                    last_update = state.get(course_id, "")
+                    new = [submission for submission in submissions
+                           if self.__time_key(submission.get("updateTime")) > last_update]
+                    for submission in new:
+                        file.write(json.dumps(submission) + "\n")
+                    file.flush()
+                    exported += len(new)
+
+                    if submissions:
+                        state[course_id] = max(
+                            [last_update] + [self.__time_key(submission.get("updateTime"))
+                                             for submission in submissions])
+                    with open(state_path, "w") as state_file:
+                        state_file.write(json.dumps(state))
+                    print(
+                        f"Exported {len(new)} of {len(submissions)} submissions of {course_id}")
+        finally:
+            self.rate_limiter = None
+
+        print(f"Exported {exported} submissions of {len(course_ids)} courses to {path}")
+        return exported
+
     def save(self, iterable: list[Student | Course]):
         if iterable:
             if type(iterable[0]) == Student:
-                data = {iterable[0].course_id: [
-                    student.full_name for student in iterable]}
-                path = "data/students.json"
+                self.database.replace_roster(
+                    iterable[0].course_id, [student.full_name for student in iterable])
             elif type(iterable[0]) == Course:
-                data = {course.id: course.as_dict() for course in iterable}
-                path = "data/courses.json"
-
-            try:
-                with open(path) as file:
-                    old_data = json.loads(file.read())
-            except (FileNotFoundError, json.decoder.JSONDecodeError):
-                old_data = {}
-
-            with open(path, "w") as file:
-                old_data.update(data)
-                file.write(json.dumps(old_data))
-
-    def generate_database(self):
+                self.database.upsert_courses(
+                    course.as_dict() for course in iterable)
+
+    def generate_database(self, workers=8, requests_per_minute=600):
+        """
+        Regenerates the courses and students database. Rosters are fetched
+        concurrently by `workers` threads, together making at most
+        `requests_per_minute` calls to the Classroom API.
+        """
+        self.rate_limiter = RateLimiter(requests_per_minute)
         courses = self.get_courses()
         self.save(courses)
-        for course in courses:
-            students = self.get_students(course.id)
+        for index, (course, students) in enumerate(self.fetch_rosters(courses, workers), 1):
             self.save(students)
+            print(
+                f"Fetched students of {course.name} ({index}/{len(courses)})")
+        self.rate_limiter = None
         self.last_updated = self.__get_todays_date()
         self.data_till = self.__get_todays_date()
         self.__save_metadata()
 
+    def sync_database(self, full=False, workers=8, requests_per_minute=600, roster_max_age_hours=24):
+        """
+        Refreshes the database incrementally. Only rosters of courses that
+        are new, whose `updateTime` changed since the last sync, or that
+        were last fetched more than `roster_max_age_hours` ago are fetched
+        (every roster if `full` is set), and only rosters that differ from
+        the stored ones are written. Students joining or leaving a course
+        do not change its `updateTime`, hence the maximum age.
+
+        Progress is checkpointed after every course, so an interrupted sync
+        resumes with the courses it had not finished.
+        """
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        stored_courses = self.database.get_courses()
+        checks = self.database.get_roster_checks()
+        stale = datetime.now(timezone.utc) - timedelta(hours=roster_max_age_hours)
+        pending = self.database.get_pending()
+
+        courses = self.get_courses(all_pages=True)
+
+        if pending:
+            print(f"Resuming interrupted sync ({len(pending)} courses left).")
+        else:
+            pending = {
+                course.id for course in courses
+                if full
+                or course.id not in checks
+                or checks[course.id] is None or checks[course.id] < stale
+                or stored_courses.get(course.id, {}).get("time_updated") != course.time_updated
+            }
+            self.database.set_pending(pending)
+
+        # course details are cheap to store, so all of them are refreshed
+        self.save(courses)
+
+        changed = 0
+        to_fetch = [course for course in courses if course.id in pending]
+        for course, students in self.fetch_rosters(to_fetch, workers):
+            names = [student.full_name for student in students]
+            old_names = self.database.get_roster(course.id)
+            if old_names is None or set(old_names) != set(names):
+                added = len(set(names) - set(old_names or []))
+                removed = len(set(old_names or []) - set(names))
+                self.database.replace_roster(course.id, names)
+                print(
+                    f"Updated students of {course.name} (+{added}, -{removed})")
+                changed += 1
+            else:
+                self.database.roster_checked(course.id)
+
+        self.rate_limiter = None
+        self.last_updated = self.__get_todays_date()
+        self.data_till = self.__get_todays_date()
+        self.__save_metadata()
+        print(
+            f"Checked {len(to_fetch)} of {len(courses)} courses, {changed} rosters changed.")
+
     def get_absentees(self, attendees):
         # attendee {
         #     'Course ID': 'adsfadfadsf',
@@ -192,64 +385,40 @@ class ClassroomClient(BaseClient):
         #     'Date': '2024-05-4T23:26:18+05:00Z'
         # }
 
+        # Absentees are resolved per course and day: a student who attended
+        # any meeting of a course on a day is not absent that day.
         absentees = []
         course_attendees = {}
         for attendee in attendees:
-            course_id = attendee["Course ID"]
+            key = (attendee["Course ID"], attendee["Date"])
 
             try:
-                course_attendees[course_id].append(attendee)
+                course_attendees[key].append(attendee)
             except KeyError:
-                course_attendees[course_id] = [attendee]
-
-        students = json.load(open(self.students_path))
-        courses = json.load(open(self.courses_path))
+                course_attendees[key] = [attendee]
 
-        for course_id, attendees_info in course_attendees.items():
+        for (course_id, date), attendees_info in course_attendees.items():
             if not course_id:
                 continue
 
-            try:
-                course_students = students[course_id]
-            except KeyError:
+            course = self.database.get_course(course_id)
+            course_students = self.database.get_roster(course_id)
+            if course is None or course_students is None:
                 print(
                     f"No students list found in database linked with {course_id}")
                 print(f"Cannot fetch absentees for {course_id}")
                 print(f"Recommended to regenerate the database.")
                 continue
 
-            course_attendee_students = [student for student in course_students if any(
-                [attendee_info["Last name"] in student for attendee_info in attendees_info])]
-            course_absentee_students = list(
-                set(course_students) - set(course_attendee_students))
-
-            for absentee_name in course_absentee_students:
-                reversed_name = absentee_name[::-1]
-                flag = False
-                last_name = ""
-
-                for chr in reversed_name:
-                    if flag and chr == " ":
-                        last_name = last_name[::-1]
-                        break
-                    if chr in "abcdefghijklmnopqrstuvwxyz":
-                        flag = True
-                    last_name += chr
-                else:
-                    last_name = absentee_name.split(" ")[-1]
-
-                first_name = absentee_name[:absentee_name.index(
-                    last_name)].strip()
-
-                absentees.append({
-                    "First name": first_name,
-                    "Last name": last_name,
-                    "Course ID": course_id,
-                    "Course": courses[course_id]["description"],
-                    "Date": attendees_info[0]["Date"],
-                })
+            roster = RosterIndex(course_students)
+            last_names = {attendee_info["Last name"]
+                          for attendee_info in attendees_info}
+
+            for first_name, last_name, _ in roster.absentees(last_names):
+                absentees.append(Absentee(
+                    first_name, last_name, date, course["description"], course_id))
 
             print(
-                f'Collected absentees for {courses[course_id]["meet_link"].split("/")[-1]}')
+                f'Collected absentees for {course["meet_link"].split("/")[-1]} on {date}')
 
         return absentees
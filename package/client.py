@@ -1,10 +1,108 @@
 import json
-import pytz
 import os
+import random
+import time
+import threading
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from datetime import datetime
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.errors import HttpError
+from datetime import datetime, timezone
+from .metrics import InstrumentedHttp, metrics, service_name
+
+# Modules only needed by some runs (the OAuth flow, token refreshes, the
+# discovery-based service builder) are imported where they are used, to
+# keep the startup of short runs fast.
+
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Credentials files are read once per process and shared by every client
+# using them, and so are the services built for each credentials entry.
+_credentials_files = {}
+_services = {}
+_cache_lock = threading.RLock()
+_http_factory = None
+_replaying = False
+
+
+def set_http_factory(factory, replaying=False):
+    """
+    Sets the callable creating the HTTP connections of every Google client,
+    for example to run the clients against local fakes. Clients created
+    afterwards use it.
+
+    If `replaying` is set, the connections answer with recorded responses
+    (see `Cassette`): the stored tokens are used as they are, whatever
+    their expiry, since a token refresh was not recorded.
+    """
+    global _http_factory, _replaying
+    with _cache_lock:
+        _http_factory = factory
+        _replaying = replaying
+        _services.clear()
+
+
+def is_replaying():
+    return _replaying
+
+
+def new_http():
+    """Returns a new, unauthorized HTTP connection, with its requests
+    recorded in `metrics`."""
+    if _http_factory is None:
+        from googleapiclient.http import build_http
+        return InstrumentedHttp(build_http())
+    return InstrumentedHttp(_http_factory())
+
+
+def load_credentials(path):
+    """Returns the (cached) contents of a credentials file, or None if the
+    file does not exist."""
+    with _cache_lock:
+        if path not in _credentials_files:
+            try:
+                with open(path) as file:
+                    _credentials_files[path] = dict(json.load(file))
+            except FileNotFoundError:
+                return None
+        return _credentials_files[path]
+
+
+def save_credentials(path, credentials):
+    with _cache_lock:
+        _credentials_files[path] = credentials
+        with open(path, "w") as file:
+            file.write(json.dumps(credentials))
+
+
+def execute(request, http=None, retries=5, base_delay=1, max_delay=32):
+    """
+    Executes a googleapiclient request, retrying quota errors (429),
+    server errors (5xx) and timeouts with exponential backoff and full
+    jitter. A Retry-After header sent by the server is honored. Other
+    errors, and the last failure, are raised.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return request.execute(http=http)
+        except HttpError as e:
+            if e.resp.status not in RETRYABLE_STATUSES or attempt == retries:
+                raise
+            reason = f"HTTP {e.resp.status}"
+            retry_after = e.resp.get("retry-after")
+        except (TimeoutError, ConnectionError) as e:
+            if attempt == retries:
+                raise
+            reason = type(e).__name__
+            retry_after = None
+
+        metrics.record_retry(service_name(
+            getattr(request, "uri", None) or getattr(request, "_batch_uri", None)))
+        delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        print(f"Google API request failed ({reason}), retrying in {delay:.1f}s.")
+        time.sleep(delay)
 
 
 class BaseClient:
@@ -28,29 +126,23 @@ class BaseClient:
 
         os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
 
-        # check if credentials.json is available
-        try:
-            with open(self.credentials_path):
-                credentials_available = True
-        except FileNotFoundError:
-            credentials_available = False
+        self.credentials = load_credentials(self.credentials_path)
+        renewed = True
 
-        if not credentials_available or force_renew:
+        if self.credentials is None or force_renew:
             self.credentials = self.__generate_credentials()
+        elif not _replaying and self.__check_is_expired():
+            self.credentials = self.__refresh_credentials()
         else:
-            self.credentials = self.__get_credentials()
-            if self.__check_is_expired():
-                self.credentials = self.__generate_credentials()
+            renewed = False
 
         # run setup
-        self.__setup()
-
-    def __get_credentials(self):
-        with open(self.credentials_path) as file:
-            return dict(json.load(file))
+        self.__setup(renewed)
 
     def __generate_credentials(self):
-        credentials = dict(json.load(open(self.credentials_path)))
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        credentials = dict(load_credentials(self.credentials_path) or {})
         flow = InstalledAppFlow.from_client_secrets_file(
             self.client_secret_path, self.scopes
         )
@@ -59,22 +151,67 @@ class BaseClient:
         credentials.update(
             {self.service_name: json.loads(self._creds.to_json())}
         )
-        with open(self.credentials_path, "w") as file:
-            file.write(json.dumps(credentials))
+        save_credentials(self.credentials_path, credentials)
         return credentials
 
-    def __setup(self):
-        self._creds = Credentials.from_authorized_user_info(
+    def __refresh_credentials(self):
+        # Expired access tokens are renewed with the refresh token; the
+        # browser flow is only needed when that is missing or revoked.
+        from google.auth.exceptions import RefreshError
+        from google_auth_httplib2 import Request
+
+        creds = Credentials.from_authorized_user_info(
             self.credentials[self.service_name], self.scopes)
-        self.service = build(
-            self.service_name, self.build_version, credentials=self._creds)
+        if not creds.refresh_token:
+            return self.__generate_credentials()
+        try:
+            creds.refresh(Request(new_http()))
+        except RefreshError:
+            return self.__generate_credentials()
+
+        credentials = dict(self.credentials)
+        credentials[self.service_name] = json.loads(creds.to_json())
+        save_credentials(self.credentials_path, credentials)
+        return credentials
+
+    def __setup(self, renewed):
+        from googleapiclient.discovery import build
+
+        key = (self.credentials_path, self.service_name, self.build_version)
+        with _cache_lock:
+            if renewed or key not in _services:
+                creds = Credentials.from_authorized_user_info(
+                    self.credentials[self.service_name], self.scopes)
+                if _replaying:
+                    # or google-auth refreshes it before the first request
+                    creds.expiry = None
+                # The discovery documents shipped with googleapiclient are
+                # used instead of fetching them.
+                service = build(
+                    self.service_name, self.build_version,
+                    http=AuthorizedHttp(creds, http=new_http()),
+                    static_discovery=True, cache_discovery=False)
+                _services[key] = (creds, service)
+            self._creds, self.service = _services[key]
+
+    def execute(self, request, http=None, retries=5):
+        """Executes a request of `self.service`, see `execute`."""
+        return execute(request, http=http, retries=retries)
+
+    def authorized_http(self):
+        """
+        Returns a new authorized HTTP connection for executing requests of
+        `self.service`. The connections are not thread-safe, so every thread
+        executing requests needs its own.
+        """
+        return AuthorizedHttp(self._creds, http=new_http())
 
     def __check_is_expired(self):
         try:
             target = datetime.fromisoformat(
-                self.credentials[self.service_name]["expiry"].replace('Z', '+00:00')).replace(tzinfo=pytz.UTC)
+                self.credentials[self.service_name]["expiry"].replace('Z', '+00:00')).replace(tzinfo=timezone.utc)
         except KeyError:
             raise Exception(
                 f"Invalid credentials. Use {self.service_name} client with force_renew=True")
-        current_time = datetime.utcnow().replace(tzinfo=pytz.UTC)
+        current_time = datetime.now(timezone.utc)
         return current_time >= target
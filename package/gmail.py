@@ -1,10 +1,93 @@
 import os
+import re
 import json
-import pytz
-from datetime import datetime
+import time
+import base64
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from simplegmail import Gmail
 from simplegmail.query import construct_query
+from googleapiclient.errors import HttpError
+from oauth2client.client import HttpAccessTokenRefreshError, OAuth2Credentials, Storage
+from googleapiclient.discovery import build
+from .client import RETRYABLE_STATUSES, execute, is_replaying, load_credentials, new_http, save_credentials
+from .metrics import metrics
 from .sheets import SheetsClient
+from .index import CourseIndex
+from .records import Attendee
+from .store import Database
+
+
+SPREADSHEET_PATTERN = re.compile(
+    r"https://docs\.google\.com/spreadsheets/d/([a-zA-Z0-9_-]+)")
+
+# Only the parts of a message needed to find the sheet link and the date.
+MESSAGE_FIELDS = (
+    "id,internalDate,"
+    "payload(body/data,parts(body/data,parts(body/data,parts(body/data))))"
+)
+
+# Incremental runs retry a message that could not be fetched, or whose
+# sheet could not be downloaded, this many times before giving up on it.
+MAX_SKIPPED_RUNS = 5
+
+
+class MeetingMessage:
+    """The parts of a meeting records email used by `get_attendees`."""
+
+    def __init__(self, message) -> None:
+        self.id = message["id"]
+        # internalDate is in milliseconds since the epoch
+        self.date = str(datetime.fromtimestamp(
+            int(message["internalDate"]) // 1000).astimezone())
+        self.spreadsheet_id = None
+
+        for data in self.__body_parts(message.get("payload", {})):
+            text = base64.urlsafe_b64decode(
+                data + "=" * (-len(data) % 4)).decode("utf-8", "replace")
+            match = SPREADSHEET_PATTERN.search(text)
+            if match:
+                self.spreadsheet_id = match.group(1)
+                break
+
+    @classmethod
+    def __body_parts(cls, part):
+        if part.get("body", {}).get("data"):
+            yield part["body"]["data"]
+        for sub_part in part.get("parts", []):
+            yield from cls.__body_parts(sub_part)
+
+
+class CredentialsStore(Storage):
+    """
+    oauth2client store of the Gmail token in the shared credentials file.
+    oauth2client saves a token renewed mid-run (a long daemon, a 401) in
+    the store of the credentials; simplegmail's file store would replace
+    the whole file with it, dropping the tokens of the other services.
+    """
+
+    def __init__(self, path) -> None:
+        super().__init__(lock=threading.Lock())
+        self.path = path
+
+    def locked_get(self):
+        credentials = load_credentials(self.path)
+        if not credentials or "access_token" not in credentials:
+            return None
+        creds = OAuth2Credentials.from_json(json.dumps(credentials))
+        creds.set_store(self)
+        return creds
+
+    def locked_put(self, credentials):
+        merged = dict(load_credentials(self.path) or {})
+        merged.update(json.loads(credentials.to_json()))
+        save_credentials(self.path, merged)
+
+    def locked_delete(self):
+        pass
 
 
 class GmailClient:
@@ -12,9 +95,10 @@ class GmailClient:
     Initializes the gmail API for getting the
     attendence sheets as soon as they are created. 
 
-    This client is meant to be run a few times a day so new credentials are
-    generated each time it is run. So I have added an optional parameter to 
-    force the renewal of credentials.
+    This client is meant to be run a few times a day so the access token has
+    usually expired when it is run. Expired tokens are renewed with the
+    refresh token, and I have added an optional parameter to force the
+    renewal of credentials.
 
     When the GmailCLient object is created, user will pass the client_secret
     that can be downloaded from the workspace OAuth.
@@ -24,129 +108,412 @@ class GmailClient:
 
     """
 
-    def __init__(self, client_secret_path="data/secret.json", credentials_path="data/credentials.json", courses_path="data/courses.json", force_renew=False) -> None:
+    def __init__(self, client_secret_path="data/secret.json", credentials_path="data/credentials.json", courses_path="data/courses.json", students_path="data/students.json", database_path="data/attendance.db", state_path="data/gmail_state.json", sheet_cache_path="data/sheet_cache.db", token_path="data/gmail_token.json", force_renew=False) -> None:
 
         self.credentials_path = credentials_path
         self.client_secret_path = client_secret_path
         self.courses_path = courses_path
+        # the rosters of the same account, if the database is migrated from here
+        self.database = Database(database_path, courses_path, students_path)
+        self.course_index = None
+        self.state_path = state_path
+        self.token_path = token_path
+        self._new_history_id = None
+        self.processed_ids = []
+        self.skipped_ids = []
+        self.rate_limiter = None
 
-        # check if credentials.json is available
-        try:
-            with open(self.credentials_path):
-                credentials_available = True
-        except FileNotFoundError:
-            credentials_available = False
+        self.credentials = load_credentials(self.credentials_path)
 
-        if not credentials_available or force_renew:
+        if self.credentials is None or force_renew:
             self.credentials = self.__generate_credentials()
-        else:
-            self.credentials = self.__get_credentials()
-            if self.__check_is_expired():
-                self.credentials = self.__generate_credentials()
+        elif not is_replaying() and self.__check_is_expired():
+            self.credentials = self.refresh_credentials()
 
         # gmail setup
         self.__gmail_setup()
 
-        self.sheets = SheetsClient(force_renew=force_renew)
+        self.sheets = SheetsClient(
+            client_secret_path=client_secret_path,
+            credentials_path=credentials_path,
+            courses_path=courses_path,
+            cache_path=sheet_cache_path,
+            force_renew=force_renew
+        )
 
     def __generate_credentials(self):
-        credentials = dict(json.load(open(self.client_secret_path)))
-        # generate gmail_token.json
-        self._gmail = Gmail(client_secret_file=self.client_secret_path)
-        # merge gmail_token.json into the credentials dictionary then delete gmail_token.json
-        credentials.update(json.load(open("gmail_token.json")))
-        os.remove("gmail_token.json")
+        # keep the tokens of the other services stored in the same file
+        credentials = dict(load_credentials(self.credentials_path) or {})
+        credentials.update(json.load(open(self.client_secret_path)))
+        # generate the token file
+        self._gmail = Gmail(client_secret_file=self.client_secret_path,
+                            creds_file=self.token_path)
+        # merge the token file into the credentials dictionary then delete it
+        credentials.update(json.load(open(self.token_path)))
+        os.remove(self.token_path)
         # save credentials to disk
-        with open(self.credentials_path, "w") as file:
-            file.write(json.dumps(credentials))
+        save_credentials(self.credentials_path, credentials)
         return credentials
 
-    def __get_credentials(self):
-        with open(self.credentials_path) as file:
-            return dict(json.load(file))
+    def refresh_credentials(self):
+        """
+        Renews the Gmail access token with the stored refresh token, so the
+        browser flow is only needed when the refresh token is revoked.
+        The renewed token is saved next to the other services' tokens.
+        """
+        if not self.credentials.get("refresh_token"):
+            return self.__generate_credentials()
+        creds = OAuth2Credentials.from_json(json.dumps(self.credentials))
+        try:
+            creds.refresh(new_http())
+        except HttpAccessTokenRefreshError:
+            return self.__generate_credentials()
+
+        credentials = dict(self.credentials)
+        credentials.update(json.loads(creds.to_json()))
+        save_credentials(self.credentials_path, credentials)
+        return credentials
 
     def __check_is_expired(self):
         try:
             target = datetime.fromisoformat(
-                self.credentials["token_expiry"].replace('Z', '+00:00')).replace(tzinfo=pytz.UTC)
+                self.credentials["token_expiry"].replace('Z', '+00:00')).replace(tzinfo=timezone.utc)
         except KeyError:
             raise Exception(
                 "Invalid credentials. Use GmailClient with force_renew=True")
-        current_time = datetime.utcnow().replace(tzinfo=pytz.UTC)
+        current_time = datetime.now(timezone.utc)
         return current_time >= target
 
     def __gmail_setup(self):
         self._gmail = Gmail(
             client_secret_file=self.credentials_path, creds_file=self.credentials_path)
+        # renewed tokens are merged into the credentials file, not written
+        # over it (see `CredentialsStore`)
+        self._gmail.creds.set_store(CredentialsStore(self.credentials_path))
+        if is_replaying():
+            # or batch requests refresh it first
+            self._gmail.creds.token_expiry = None
+        # simplegmail handles the credentials; requests are made through a
+        # service built on the shared HTTP factory.
+        self.service = build(
+            "gmail", "v1", http=self._gmail.creds.authorize(new_http()),
+            static_discovery=True, cache_discovery=False)
         self._query = construct_query(
             exact_phrase="Meeting records from",
             sender="meetings-noreply@google.com",
-            # TODO: Change this
-            # after="2024/06/06",
-            # before="2024/06/14"
             # unread=False,
             # read=True,
             newer_than=(1, "Day"),
-            # newer_than=(1, "Month"),
         )
 
+    @staticmethod
+    def window_query(after, before):
+        """The meeting records query for messages received on or after the
+        date `after` and before the date `before` (YYYY/MM/DD)."""
+        return construct_query(
+            exact_phrase="Meeting records from",
+            sender="meetings-noreply@google.com",
+            after=after,
+            before=before,
+        )
+
+    def authorized_http(self):
+        """
+        Returns a new authorized HTTP connection for executing requests of
+        `self.service` from another thread.
+        """
+        return self._gmail.creds.authorize(new_http())
+
+    def __wait(self):
+        if self.rate_limiter:
+            self.rate_limiter.wait()
+
+    def __load_state(self):
+        # {"historyId": ..., "skipped": {message ID: runs it was skipped}}
+        try:
+            with open(self.state_path) as file:
+                return json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}
+
+    def __save_state(self, history_id, skipped):
+        with open(self.state_path, "w") as file:
+            file.write(json.dumps({"historyId": history_id, "skipped": skipped}))
+
+    def __list_message_refs(self, query=None, http=None):
+        refs = []
+        request = self.service.users().messages().list(
+            userId="me", q=query or self._query)
+        while request is not None:
+            self.__wait()
+            response = execute(request, http=http)
+            refs.extend(response.get("messages", []))
+            request = self.service.users().messages().list_next(
+                request, response)
+        return refs
+
+    def __added_message_ids(self, history_id):
+        """Returns the IDs of the messages added since `history_id` and the
+        latest history ID."""
+        added = set()
+        request = self.service.users().history().list(
+            userId="me", startHistoryId=history_id, historyTypes=["messageAdded"])
+        while request is not None:
+            response = execute(request)
+            for record in response.get("history", []):
+                for message_added in record.get("messagesAdded", []):
+                    added.add(message_added["message"]["id"])
+            history_id = response.get("historyId", history_id)
+            request = self.service.users().history().list_next(
+                request, response)
+        return added, history_id
+
+    def get_new_message_refs(self):
+        """
+        Returns the meeting record messages that arrived since the last
+        call, using the Gmail History API. Nothing but the history is
+        listed when no message arrived. The first call, or a call whose
+        stored history ID expired, falls back to the full query.
+
+        The new history ID is only stored by `commit_history`, which callers
+        call once the records of the messages are uploaded, so messages are
+        seen again if the run fails. The messages skipped by the last
+        committed run (see `iter_meetings`) are returned again too.
+        """
+        state = self.__load_state()
+        history_id = state.get("historyId")
+        retried = list(state.get("skipped", {}))
+        added = None
+
+        if history_id is not None:
+            try:
+                added, self._new_history_id = self.__added_message_ids(
+                    history_id)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                print("Stored Gmail history ID expired, running the full query.")
+
+        if added is None:
+            self._new_history_id = execute(
+                self.service.users().getProfile(userId="me"))["historyId"]
+            refs = self.__list_message_refs()
+        elif not added:
+            refs = []
+        else:
+            refs = [ref for ref in self.__list_message_refs()
+                    if ref["id"] in added]
+
+        listed = {ref["id"] for ref in refs}
+        return refs + [{"id": message_id} for message_id in retried
+                       if message_id not in listed]
+
+    @property
+    def new_history_id(self):
+        """The history ID reached by the last `get_new_message_refs`, not
+        committed yet."""
+        return self._new_history_id
+
+    def commit_history(self, history_id=None, skipped_ids=None):
+        """
+        Stores `history_id`, by default the history ID reached by the last
+        `get_new_message_refs`, with the messages skipped by the run
+        (`skipped_ids`, by default those of the last `iter_meetings`), so
+        the next run retries them although the history moved past them.
+        """
+        history_id = history_id or self._new_history_id
+        skipped_ids = self.skipped_ids if skipped_ids is None else skipped_ids
+        if not history_id:
+            return
+        runs = self.__load_state().get("skipped", {})
+        skipped = {}
+        for message_id in skipped_ids:
+            skipped[message_id] = runs.get(message_id, 0) + 1
+            if skipped[message_id] >= MAX_SKIPPED_RUNS:
+                print(f"Message {message_id} was skipped {MAX_SKIPPED_RUNS} times, giving up on it.")
+                del skipped[message_id]
+        self.__save_state(history_id, skipped)
+        self._new_history_id = None
+
     @staticmethod
     def format_date(date):
         date_obj = datetime.strptime(date, "%Y-%m-%d %H:%M:%S%z")
         return date_obj.strftime('%Y-%m-%d')
 
-    def get_attendees(self):
-        """every item will
-        be a dictionary with key-value pairs (keys being the headers+Date+code)
-        for every attendee there will be a different message appended"""
+    def fetch_messages(self, refs, batch_size=50, http=None, skipped=None, retries=5,
+                       base_delay=1, max_delay=32):
+        """
+        Fetches messages in Gmail batch requests of `batch_size`, asking
+        only for the fields needed to build a `MeetingMessage`. Messages
+        are returned in the order of `refs`; messages that could not be
+        fetched are left out.
 
-        messages = []
-        courses = [value for value in list(json.load(
-            open(self.courses_path)).values())]
+        Gmail fails single requests of a batch (429 mostly) rather than the
+        whole batch, so those are sent again in a new batch, with the same
+        backoff as `execute`. The IDs of the messages that still failed
+        are appended to `skipped`.
+        """
+        responses = {}
+        failed = []
 
-        gmail_messages = self._gmail.get_messages(query=self._query)
+        def callback(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+            elif isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUSES:
+                failed.append(request_id)
+            else:
+                print(f"Failed to fetch message {request_id} ({exception}).")
 
-        for message in gmail_messages:
-            try:
-                half_link = "https://docs.google.com/spreadsheets/d"
-                link = half_link + \
-                    message.html.split(half_link)[1].split("\"")[0]
-            except IndexError:
+        service = self.service
+        pending = [ref["id"] for ref in refs]
+        for attempt in range(retries + 1):
+            for start in range(0, len(pending), batch_size):
+                batch = service.new_batch_http_request(callback=callback)
+                for message_id in pending[start:start + batch_size]:
+                    batch.add(
+                        service.users().messages().get(
+                            userId="me", id=message_id, format="full", fields=MESSAGE_FIELDS),
+                        request_id=message_id
+                    )
+                self.__wait()
+                execute(batch, http=http)
+
+            if not failed or attempt == retries:
+                break
+            pending, failed = failed, []
+            metrics.record_retry("gmail")
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            print(f"Failed to fetch {len(pending)} messages, retrying in {delay:.1f}s.")
+            time.sleep(delay)
+
+        for message_id in failed:
+            print(f"Failed to fetch message {message_id}, skipping it.")
+        if skipped is not None:
+            skipped.extend(failed)
+
+        return [MeetingMessage(responses[ref["id"]])
+                for ref in refs if ref["id"] in responses]
+
+    def mark_as_read(self, message_ids, http=None):
+        """Marks the messages as read, 1000 (the API limit) per request."""
+        for start in range(0, len(message_ids), 1000):
+            self.__wait()
+            execute(self.service.users().messages().batchModify(
+                userId="me",
+                body={"ids": message_ids[start:start + 1000],
+                      "removeLabelIds": ["UNREAD"]}
+            ), http=http)
+
+    def to_attendees(self, spreadsheet, date):
+        """
+        Converts a downloaded attendance sheet into `Attendee` records.
+        Returns the meeting code of the sheet and the attendees.
+        """
+        attendees = []
+        meeting_code = spreadsheet["title"].split(" ")[2]
+        data = spreadsheet["data"]
+        indexes = Attendee.column_indexes(data[0] if data else [])
+        course = self.course_index.lookup(meeting_code)
+        if course:
+            course_description, course_id = course["description"], course["id"]
+        else:
+            course_description, course_id = None, None
+
+        for attendee in data[1:]:
+            if len(attendee) == 6:
+                attendees.append(Attendee.from_row(
+                    attendee, indexes, date, meeting_code, course_description, course_id))
+            else:
+                print("Invalid attendee attributes.")
+
+        return meeting_code, attendees
+
+    def iter_meetings(self, workers=8, incremental=False, query=None, http=None, skipped=None):
+        """
+        Yields (message, meeting code, attendees) for every meeting records
+        message, in the order of the messages.
+
+        The attendance sheets are downloaded concurrently by `workers`
+        threads, each with its own HTTP connection. At most `workers` sheets
+        are downloaded ahead of the one being yielded, so memory stays
+        bounded however many messages there are. Messages are not marked as
+        read; that is left to the caller.
+
+        If `incremental` is set, only messages that arrived since the last
+        incremental run are processed (see `get_new_message_refs`).
+        Otherwise the messages matching `query` are (by default those of
+        the last day). `http` is the connection used for the Gmail
+        requests, needed when meetings are iterated from several threads.
+
+        The IDs of the messages that could not be fetched, or whose sheet
+        could not be downloaded, are appended to `skipped`, by default
+        `skipped_ids`.
+        """
+        self.course_index = CourseIndex(self.database)
+        if skipped is None:
+            skipped = self.skipped_ids = []
+
+        if incremental:
+            refs = self.get_new_message_refs()
+        else:
+            refs = self.__list_message_refs(query, http)
+
+        jobs = []
+        for message in self.fetch_messages(refs, http=http, skipped=skipped):
+            if message.spreadsheet_id is None:
                 print(f"No attendance sheet found. Skipping message.")
                 continue
-            spreadsheetId = link.split("/")[5]
-            data = self.sheets.get_spreadsheet(spreadsheetId)
-            if not data:
-                print(
-                    f"Failed to get data from {spreadsheetId}. Skipping message.")
-                continue
-            meeting_code = data["title"].split(" ")[2]
-            data = data["data"]
-            headers = data.pop(0)
-            date = self.format_date(message.date)
-
-            for attendee in data:
-                if len(attendee) == 6:
-                    dict_ = {header: attendee[index]
-                             for index, header in enumerate(headers)}
-                    dict_["Date"] = date
-                    dict_["Code"] = meeting_code
-
-                    for course in courses:
-                        if course["meet_link"]:
-                            if meeting_code in course["meet_link"]:
-                                dict_["Course"] = course["description"]
-                                dict_["Course ID"] = course["id"]
-                                break
-                    else:
-                        dict_["Course"] = None
-                        dict_["Course ID"] = None
-
-                    messages.append(dict_)
-                else:
-                    print("Invalid attendee attributes.")
-
-            print(f"Collected attendees for {meeting_code}")
-            message.mark_as_read()
+            jobs.append(message)
+
+        local = threading.local()
+
+        def download(spreadsheetId):
+            if not hasattr(local, "http"):
+                local.http = self.sheets.authorized_http()
+            self.__wait()
+            return self.sheets.get_spreadsheet(spreadsheetId, http=local.http)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = deque()
+
+            for message in jobs:
+                in_flight.append((message, executor.submit(
+                    download, message.spreadsheet_id)))
+                if len(in_flight) < workers:
+                    continue
+
+                yield from self.__to_meeting(*in_flight.popleft(), skipped)
+
+            while in_flight:
+                yield from self.__to_meeting(*in_flight.popleft(), skipped)
+
+    def __to_meeting(self, message, future, skipped):
+        data = future.result()
+        if not data:
+            print(
+                f"Failed to get data from {message.spreadsheet_id}. Skipping message.")
+            skipped.append(message.id)
+            return
+        meeting_code, attendees = self.to_attendees(
+            data, self.format_date(message.date))
+        print(f"Collected attendees for {meeting_code}")
+        yield message, meeting_code, attendees
+
+    def get_attendees(self, workers=8, incremental=False):
+        """every item will
+        be a dictionary with key-value pairs (keys being the headers+Date+code)
+        for every attendee there will be a different message appended
+
+        Attendees are returned in the order of the messages (see
+        `iter_meetings`). The messages whose sheet was parsed are left in
+        `processed_ids`; they are not marked as read, nor is the history
+        committed, so that callers do it once the attendees are uploaded."""
+
+        messages = []
+        self.processed_ids = []
+
+        for message, _, attendees in self.iter_meetings(workers, incremental):
+            messages.extend(attendees)
+            self.processed_ids.append(message.id)
 
         return messages
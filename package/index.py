@@ -0,0 +1,148 @@
+import re
+from functools import lru_cache
+
+
+MEET_CODE_PATTERN = re.compile(r"[a-z]{3}-[a-z]{4}-[a-z]{3}")
+
+
+def normalize_code(code):
+    """Lowercases a Meet code and drops everything but letters and digits,
+    so 'ABC-DEFG-HIJ', 'abc-defg-hij ' and 'abcdefghij' share one key."""
+    if not code:
+        return ""
+    return "".join(chr for chr in code.lower() if chr.isalnum())
+
+
+def normalize_name(name):
+    """Casefolds a name and collapses its whitespace."""
+    return " ".join(name.casefold().split())
+
+
+@lru_cache(maxsize=None)
+def split_name(full_name):
+    """
+    Splits a roster name into (first name, last name). The last name starts
+    at the last word containing a lowercase letter, so section codes that
+    follow it stay part of the last name ('Sanawar Saeed CS-101' gives
+    ('Sanawar', 'Saeed CS-101')).
+    """
+    words = full_name.split(" ")
+    for index in range(len(words) - 1, 0, -1):
+        if any(chr in "abcdefghijklmnopqrstuvwxyz" for chr in words[index]):
+            break
+    else:
+        index = len(words) - 1
+    last_name = " ".join(words[index:])
+    first_name = full_name[:full_name.index(last_name)].strip()
+    return first_name, last_name
+
+
+def course_code_from_name(last_name):
+    """
+    Derives a course code from an attendee's last name, which usually ends
+    with the code of their section (e.g. 'Saeed CS-F21-A-001-L').
+    Returns None if no code can be derived.
+    """
+    try:
+        name_code = "-".join([x for x in last_name[::-1].split("-")
+                              if x[0] not in "abcdefghijklmnopqrstuvwxyz "])[::-1].strip()
+        attrs = name_code.split("-")
+        attrs.pop(3)
+        course_code = "-".join(attrs)
+    except IndexError:
+        course_code = ""
+    return course_code or None
+
+
+def meet_codes(meet_link):
+    """Returns the normalized Meet codes found in a course's Meet link."""
+    if not meet_link:
+        return []
+    link = meet_link.lower()
+    codes = MEET_CODE_PATTERN.findall(link)
+    # Links that do not use the standard code format
+    # (e.g. meet.google.com/lookup/...) are keyed by their last segment.
+    codes.append(link.split("?")[0].rstrip("/").split("/")[-1])
+    return list(dict.fromkeys(
+        normalize_code(code) for code in codes if normalize_code(code)))
+
+
+class CourseIndex:
+    """
+    Resolves Meet codes to courses through the Meet code index of the
+    database, remembering every code it has resolved.
+    """
+
+    def __init__(self, database) -> None:
+        self.database = database
+        self.__by_code = {}
+        self.__courses = None
+        self.__fallback_codes = {}
+
+    def lookup(self, meeting_code):
+        """Returns the course linked with the meeting code, or None."""
+        key = normalize_code(meeting_code)
+        if not key:
+            return None
+        try:
+            return self.__by_code[key]
+        except KeyError:
+            pass
+
+        course = self.database.find_course(key)
+        if course is None:
+            # Meet links stored in an unexpected format still get matched
+            # the way they always were.
+            if self.__courses is None:
+                self.__courses = list(self.database.get_courses().values())
+            for course in self.__courses:
+                if course["meet_link"] and meeting_code in course["meet_link"]:
+                    break
+            else:
+                course = None
+        self.__by_code[key] = course
+        return course
+
+    def fallback_course(self, last_name):
+        """Memoized `course_code_from_name` for courses missing from the database."""
+        try:
+            return self.__fallback_codes[last_name]
+        except KeyError:
+            code = self.__fallback_codes[last_name] = course_code_from_name(
+                last_name)
+            return code
+
+
+class RosterIndex:
+    """
+    Indexes the student names of a course roster by every trailing run of
+    words of the normalized name, so an attendee's last name is matched
+    against the roster with a dictionary lookup.
+    """
+
+    def __init__(self, students: list[str]) -> None:
+        # dict.fromkeys drops duplicate names but keeps the roster order
+        self.students = list(dict.fromkeys(students))
+        self.__by_suffix = {}
+
+        for student in self.students:
+            words = normalize_name(student).split(" ")
+            for index in range(len(words)):
+                self.__by_suffix.setdefault(
+                    " ".join(words[index:]), []).append(student)
+
+    def match(self, last_names) -> set:
+        """Returns the students whose name ends with any of the last names."""
+        matched = set()
+        for last_name in last_names:
+            matched.update(self.__by_suffix.get(normalize_name(last_name), ()))
+        return matched
+
+    def absentees(self, last_names) -> list:
+        """Returns (first name, last name, full name) for every student of the
+        roster not matched by any of the last names."""
+        matched = self.match(last_names)
+        return [
+            split_name(student) + (student,)
+            for student in self.students if student not in matched
+        ]
@@ -0,0 +1,173 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from .index import normalize_name
+from .records import Record
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    course_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    code TEXT NOT NULL,
+    salesforce_id TEXT,
+    uploaded_at TEXT,
+    PRIMARY KEY (course_id, name, date, code)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS pending (
+    position INTEGER PRIMARY KEY,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS unknown (
+    course_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    code TEXT NOT NULL,
+    job TEXT NOT NULL,
+    record TEXT NOT NULL,
+    PRIMARY KEY (course_id, name, date, code)
+) WITHOUT ROWID;
+"""
+
+
+class Ledger:
+    """
+    Local record of the attendance records already uploaded to Salesforce,
+    keyed by (Course ID, normalized name, Date, Meet code).
+
+    It also journals the records of the runs in progress, so a run that
+    stopped halfway can be finished with `pending` instead of fetching and
+    uploading everything again. Journaled records are only dropped once
+    they are uploaded, so a new run does not lose the ones an earlier run
+    left.
+
+    Records a bulk job may have created (see `AttendanceClient.upload_many`)
+    are set aside as unknown: they are neither uploaded again nor pending
+    until `release_unknown` is called for their job, as retrying them
+    could create duplicates.
+    """
+
+    def __init__(self, path="data/ledger.db") -> None:
+        self.path = path
+        self.__lock = threading.RLock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__connection:
+            self.__connection.executescript(SCHEMA)
+
+    def close(self):
+        self.__connection.close()
+
+    @staticmethod
+    def key(record: dict):
+        if isinstance(record, Record):
+            return (
+                record.course_id or "",
+                record.name_key,
+                record.date or "",
+                record.get("Code") or "",
+            )
+        return (
+            record.get("Course ID") or "",
+            normalize_name(
+                f'{record.get("First name") or ""} {record.get("Last name") or ""}'),
+            record.get("Date") or "",
+            record.get("Code") or "",
+        )
+
+    @classmethod
+    def external_id(cls, record: dict):
+        """The ledger key as a single string, for upserts by external ID."""
+        return "|".join(cls.key(record))
+
+    def contains(self, record: dict):
+        """Whether the record was uploaded, or may have been (unknown)."""
+        key = self.key(record)
+        with self.__lock:
+            return self.__connection.execute(
+                "SELECT 1 FROM uploads WHERE course_id = ? AND name = ? AND date = ? AND code = ? "
+                "UNION ALL "
+                "SELECT 1 FROM unknown WHERE course_id = ? AND name = ? AND date = ? AND code = ?",
+                key + key
+            ).fetchone() is not None
+
+    def filter_new(self, records):
+        """Returns the records that have not been uploaded yet, nor may
+        have been."""
+        return [record for record in records if not self.contains(record)]
+
+    def add(self, records, results):
+        """Records the successful uploads among `results` (as returned by
+        `AttendanceClient.upload_many`), and the unknown ones."""
+        uploaded_at = datetime.now().isoformat(timespec="seconds")
+        with self.__lock, self.__connection:
+            self.__connection.executemany(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    self.key(record) + (result.get("id"), uploaded_at)
+                    for record, result in zip(records, results)
+                    if result["success"]
+                ]
+            )
+            self.__connection.executemany(
+                "INSERT OR REPLACE INTO unknown VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    self.key(record) + (result["unknown_job"],
+                                        json.dumps(record, default=Record.as_dict))
+                    for record, result in zip(records, results)
+                    if result.get("unknown_job")
+                ]
+            )
+
+    def release_unknown(self, job):
+        """Journals the unknown records of a bulk job again, once the job
+        was checked, so they are uploaded by the next run. Returns the
+        number of records released."""
+        with self.__lock, self.__connection:
+            rows = self.__connection.execute(
+                "SELECT record FROM unknown WHERE job = ?", (job,)).fetchall()
+            self.__connection.execute("DELETE FROM unknown WHERE job = ?", (job,))
+            self.__connection.executemany(
+                "INSERT INTO pending (record) VALUES (?)", [(row[0],) for row in rows])
+        return len(rows)
+
+    def begin(self, records=()):
+        """Journals the records of a new run, after the records earlier runs
+        left that are still not uploaded."""
+        self.__prune()
+        self.append(records)
+
+    def append(self, records):
+        """Adds records to the journal of the run in progress."""
+        with self.__lock, self.__connection:
+            self.__connection.executemany(
+                "INSERT INTO pending (record) VALUES (?)",
+                [(json.dumps(record, default=Record.as_dict),) for record in records]
+            )
+
+    def pending(self):
+        """Returns the journaled records not uploaded yet, once each."""
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT record FROM pending ORDER BY position").fetchall()
+        records = {}
+        for row in rows:
+            record = json.loads(row[0])
+            records.setdefault(self.key(record), record)
+        return self.filter_new(records.values())
+
+    def finish(self):
+        """Clears the uploaded records from the journal once every record of
+        the run was uploaded. Records left by earlier runs stay until they
+        are uploaded too."""
+        self.__prune()
+
+    def __prune(self):
+        with self.__lock, self.__connection:
+            left = self.pending()
+            self.__connection.execute("DELETE FROM pending")
+            self.__connection.executemany(
+                "INSERT INTO pending (record) VALUES (?)",
+                [(json.dumps(record),) for record in left]
+            )
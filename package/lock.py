@@ -0,0 +1,55 @@
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class SingleFlightLock:
+    """
+    Non-blocking inter-process lock on a file, so two runs (for example a
+    scheduled one and a manual one) never process the same data at once.
+    The operating system releases it if the process dies.
+    """
+
+    def __init__(self, path="data/attendance.lock") -> None:
+        self.path = path
+        self.__file = None
+
+    def acquire(self):
+        """Returns True if the lock was acquired, False if it is held."""
+        file = open(self.path, "a+")
+        try:
+            if fcntl:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            file.close()
+            return False
+        file.seek(0)
+        file.truncate()
+        file.write(str(os.getpid()))
+        file.flush()
+        self.__file = file
+        return True
+
+    def release(self):
+        if self.__file is None:
+            return
+        if fcntl:
+            fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.__file.seek(0)
+            msvcrt.locking(self.__file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.__file.close()
+        self.__file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
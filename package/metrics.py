@@ -0,0 +1,297 @@
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+from datetime import date
+from urllib.parse import urlsplit
+
+
+SALESFORCE_USAGE_PATTERN = re.compile(r"api-usage=(\d+)/(\d+)")
+
+
+class CallStats:
+    """Totals of the requests made to one service during one phase."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes = 0
+        self.statuses = Counter()
+
+    def add(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.retries += other.retries
+        self.seconds += other.seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        self.bytes += other.bytes
+        self.statuses.update(other.statuses)
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "seconds": round(self.seconds, 4),
+            "mean_seconds": round(self.seconds / self.calls, 4) if self.calls else 0,
+            "max_seconds": round(self.max_seconds, 4),
+            "bytes": self.bytes,
+            "statuses": {str(status): count for status, count in self.statuses.items()},
+        }
+
+
+class Metrics:
+    """
+    Records every outbound API request: its latency, status and response
+    size, plus the retries made by the clients, grouped by phase of the
+    run and service (gmail, sheets, classroom, salesforce).
+
+    Phases are set with `phase`, for the whole process since the requests
+    of a phase are made by worker threads too. The summary can be written
+    as JSON or as a Prometheus text file, and the calls are added to a
+    daily usage file, so what is left of each daily quota can be reported.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__stats = {}
+        self.__phase_seconds = {}
+        self.current_phase = None
+        self.salesforce_usage = None
+        self.started = time.time()
+        # when set, every phase is profiled into this directory
+        self.profile_dir = None
+
+    def reset(self):
+        with self.__lock:
+            self.__stats.clear()
+            self.__phase_seconds.clear()
+            self.salesforce_usage = None
+            self.started = time.time()
+
+    def __get(self, service):
+        key = (self.current_phase or "other", service)
+        if key not in self.__stats:
+            self.__stats[key] = CallStats()
+        return self.__stats[key]
+
+    def record(self, service, status, seconds, size=0):
+        with self.__lock:
+            stats = self.__get(service)
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.bytes += size
+            stats.statuses[status] += 1
+            if status is None or int(status) >= 400:
+                stats.errors += 1
+
+    def record_retry(self, service):
+        with self.__lock:
+            self.__get(service).retries += 1
+
+    def record_salesforce_limits(self, header):
+        """Stores the API usage sent by Salesforce in Sforce-Limit-Info."""
+        match = SALESFORCE_USAGE_PATTERN.search(header or "")
+        if match:
+            self.salesforce_usage = (int(match.group(1)), int(match.group(2)))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Tags the requests made inside the block with the phase `name`. If
+        `profile_dir` is set, the block is also profiled with cProfile into
+        `<profile_dir>/<name>.prof` (the calling thread only).
+        """
+        previous = self.current_phase
+        self.current_phase = name
+        profiler = None
+        if self.profile_dir:
+            import cProfile
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler = cProfile.Profile()
+            profiler.enable()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(
+                    self.profile_dir, f"{name}.prof"))
+            with self.__lock:
+                self.__phase_seconds[name] = self.__phase_seconds.get(
+                    name, 0) + elapsed
+            self.current_phase = previous
+
+    def snapshot(self):
+        """Returns what was recorded, to be merged into the metrics of
+        another process with `merge`."""
+        with self.__lock:
+            return {
+                "stats": dict(self.__stats),
+                "phase_seconds": dict(self.__phase_seconds),
+                "salesforce_usage": self.salesforce_usage,
+            }
+
+    def merge(self, snapshot):
+        """Adds the metrics recorded by another process (see `snapshot`).
+        Phase times of processes running at once are summed."""
+        with self.__lock:
+            for key, stats in snapshot["stats"].items():
+                self.__stats.setdefault(key, CallStats()).add(stats)
+            for phase, seconds in snapshot["phase_seconds"].items():
+                self.__phase_seconds[phase] = self.__phase_seconds.get(
+                    phase, 0) + seconds
+            if snapshot["salesforce_usage"]:
+                self.salesforce_usage = snapshot["salesforce_usage"]
+
+    def calls_by_service(self):
+        totals = Counter()
+        with self.__lock:
+            for (_, service), stats in self.__stats.items():
+                totals[service] += stats.calls
+        return totals
+
+    def summary(self):
+        with self.__lock:
+            phases = {}
+            for (phase, service), stats in sorted(self.__stats.items()):
+                phases.setdefault(phase, {"seconds": None, "services": {}})
+                phases[phase]["services"][service] = stats.as_dict()
+            for phase, seconds in self.__phase_seconds.items():
+                phases.setdefault(phase, {"services": {}})
+                phases[phase]["seconds"] = round(seconds, 4)
+
+        summary = {"started": self.started, "phases": phases}
+        if self.salesforce_usage:
+            used, limit = self.salesforce_usage
+            summary["salesforce_api_usage"] = {
+                "used": used, "limit": limit, "left": limit - used}
+        return summary
+
+    def to_prometheus(self):
+        lines = []
+        metrics = (
+            ("calls", "calls", "counter", "API requests made"),
+            ("errors", "errors", "counter", "API requests that failed"),
+            ("retries", "retries", "counter", "API requests retried"),
+            ("seconds", "seconds", "counter", "Time spent in API requests"),
+            ("bytes", "response_bytes", "counter", "Size of the API responses"),
+        )
+        with self.__lock:
+            items = sorted(self.__stats.items())
+            for attribute, name, kind, description in metrics:
+                lines.append(f"# HELP attendance_api_{name} {description}")
+                lines.append(f"# TYPE attendance_api_{name} {kind}")
+                for (phase, service), stats in items:
+                    lines.append(
+                        f'attendance_api_{name}{{phase="{phase}",service="{service}"}} '
+                        f"{getattr(stats, attribute)}")
+            lines.append("# HELP attendance_phase_seconds Wall time of the phases")
+            lines.append("# TYPE attendance_phase_seconds gauge")
+            for phase, seconds in sorted(self.__phase_seconds.items()):
+                lines.append(
+                    f'attendance_phase_seconds{{phase="{phase}"}} {seconds:.4f}')
+        if self.salesforce_usage:
+            used, limit = self.salesforce_usage
+            lines.append("# HELP attendance_salesforce_api_usage Daily Salesforce API requests")
+            lines.append("# TYPE attendance_salesforce_api_usage gauge")
+            lines.append(f'attendance_salesforce_api_usage{{kind="used"}} {used}')
+            lines.append(f'attendance_salesforce_api_usage{{kind="limit"}} {limit}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes the summary as a Prometheus text file if `path` ends with
+        .prom, as JSON otherwise."""
+        if path.endswith(".prom"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.summary(), indent=2)
+        # written whole and renamed, so a collector never reads half a file
+        with open(path + ".tmp", "w") as file:
+            file.write(content)
+        os.replace(path + ".tmp", path)
+
+    def update_daily_usage(self, path="data/quota_usage.json", calls=None):
+        """Adds the calls of this run (or `calls`, a count per service) to
+        today's totals and returns them."""
+        try:
+            with open(path) as file:
+                usage = json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            usage = {}
+        today = date.today().isoformat()
+        # only today's totals are kept
+        totals = Counter(usage.get(today, {}))
+        totals.update(self.calls_by_service() if calls is None else calls)
+        with open(path, "w") as file:
+            file.write(json.dumps({today: totals}))
+        return dict(totals)
+
+    def quota_report(self, usage, quotas_path="data/quotas.json"):
+        """
+        Returns a line per service with the calls made today and, for the
+        services with a daily limit in `quotas_path` ({"gmail": 1000000,
+        ...}), what is left of it. Salesforce reports its own usage.
+        """
+        try:
+            with open(quotas_path) as file:
+                quotas = json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            quotas = {}
+
+        lines = []
+        for service, calls in sorted(usage.items()):
+            if service == "salesforce" and self.salesforce_usage:
+                used, limit = self.salesforce_usage
+                lines.append(
+                    f"salesforce: {used}/{limit} API requests used in the last 24 hours, {limit - used} left")
+            elif service in quotas:
+                lines.append(
+                    f"{service}: {calls}/{quotas[service]} requests today, {quotas[service] - calls} left")
+            else:
+                lines.append(f"{service}: {calls} requests today")
+        return lines
+
+
+metrics = Metrics()
+
+
+class InstrumentedHttp:
+    """
+    Wraps an httplib2-style connection so every request made through it is
+    recorded in `metrics`, under the service named by the API host
+    (gmail.googleapis.com is recorded as gmail).
+    """
+
+    def __init__(self, http) -> None:
+        self.http = http
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        service = service_name(uri)
+        started = time.perf_counter()
+        try:
+            response, content = self.http.request(
+                uri, method, body, headers, *args, **kwargs)
+        except Exception:
+            metrics.record(service, None, time.perf_counter() - started)
+            raise
+        metrics.record(service, response.status,
+                       time.perf_counter() - started, len(content or b""))
+        return response, content
+
+
+def service_name(uri):
+    host = urlsplit(uri or "").hostname or ""
+    return host.split(".")[0] or "unknown"
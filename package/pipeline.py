@@ -0,0 +1,222 @@
+import asyncio
+from .metrics import metrics
+from .records import COLLECTION_SIZE
+
+
+def fill_missing_courses(attendees, course_index):
+    """
+    Sets the course of attendees whose meeting is not linked with a course
+    in the database to the course code extracted from their last name.
+    Returns the course codes that were set.
+    """
+    missing_courses = []
+    for attendee in attendees:
+        if attendee["Course"] == None:
+            course_code = course_index.fallback_course(attendee["Last name"])
+            missing_courses.append(course_code)
+            attendee["Course"] = course_code
+    return missing_courses
+
+
+def drop_present(absentees, attendees):
+    """Returns the absentees that do not appear among the attendees."""
+    # Create a set of unique keys for attendees using Course ID, Last name, and Date
+    attendees_set = {
+        (attendee["Course ID"], attendee["Last name"].strip(), attendee["Date"])
+        for attendee in attendees
+    }
+    return [
+        absentee for absentee in absentees
+        if (absentee["Course ID"], absentee["Last name"].strip(), absentee["Date"]) not in attendees_set
+    ]
+
+
+def report_results(records, results):
+    for record, result in zip(records, results):
+        kind = "attendance" if "Duration" in record else "absence"
+        if result["success"]:
+            print(
+                f'Uploaded {kind} for {record["Last name"]} (Course: {record["Course"]})')
+        else:
+            errors = "; ".join(error.get("message", "")
+                               for error in result["errors"])
+            print(
+                f'Failed to upload {kind} for {record["Last name"]} (Course: {record["Course"]}): {errors}')
+
+
+def upload_records(ac, ledger, records, external_id_field=None):
+    """Uploads the records not in the ledger, recording each successful
+    upload as soon as its batch is sent. Returns True if every record was
+    uploaded."""
+    new_records = ledger.filter_new(records)
+    skipped = len(records) - len(new_records)
+    records = new_records
+    if skipped:
+        print(f"Skipping {skipped} records already uploaded.")
+
+    results = ac.upload_many(
+        records,
+        external_id_field=external_id_field,
+        external_id=ledger.external_id,
+        callback=ledger.add,
+    )
+
+    report_results(records, results)
+
+    if all(result["success"] for result in results):
+        ledger.finish()
+        return True
+    return False
+
+
+def run_phased(gc, cc, ac, ledger, incremental=False, external_id_field=None, rollup=None):
+    """Collects every attendee, then every absentee, then uploads them all.
+    The records are counted in `rollup`, if given. Returns True if every
+    record was uploaded."""
+    print("Getting attendees...")
+    with metrics.phase("get_attendees"):
+        attendees = gc.get_attendees(incremental=incremental)
+    print("Getting absentees...")
+    with metrics.phase("get_absentees"):
+        absentees = cc.get_absentees(attendees)
+
+    missing_courses = fill_missing_courses(attendees, gc.course_index)
+
+    print(f"Missing courses: {list(set(missing_courses))}")
+    print("This may be due to these courses being older than or newer than the database\ngeneration period. ")
+    print("Auto setting them to course code extracted from attendee names.")
+
+    print()
+
+    print("Uploading to salesforce...")
+
+    records = attendees + drop_present(absentees, attendees)
+    if rollup is not None:
+        rollup.add(records)
+    ledger.begin(records)
+    with metrics.phase("upload"):
+        uploaded = upload_records(ac, ledger, records, external_id_field)
+
+    # Messages are only marked as read, and the history committed, once
+    # their records are uploaded, so a failed run sees them again.
+    if uploaded:
+        gc.mark_as_read(gc.processed_ids)
+        if incremental:
+            gc.commit_history()
+    return uploaded
+
+
+class StreamingPipeline:
+    """
+    Streams meetings from Gmail to Salesforce. The attendees of every
+    meeting sheet go on to a batching uploader as soon as it is downloaded,
+    so Gmail, Sheets and Salesforce requests overlap. The stages are
+    connected by bounded queues: when the uploader falls behind, the
+    downloads wait.
+
+    Absentees are resolved once every meeting was seen, per course and day
+    like in `run_phased` (a student at any meeting of the day is not
+    absent), so both modes upload the same records. Only the (course ID,
+    date, last name) of the attendees are kept until then; their records
+    are released once uploaded. The records are counted in `rollup`, if
+    given.
+    """
+
+    def __init__(self, gc, cc, ac, ledger, queue_size=4, batch_size=COLLECTION_SIZE, external_id_field=None,
+                 rollup=None) -> None:
+        self.gc = gc
+        self.cc = cc
+        self.ac = ac
+        self.ledger = ledger
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.external_id_field = external_id_field
+        self.rollup = rollup
+
+    def run(self, incremental=False):
+        """Runs the pipeline. Returns True if every record was uploaded."""
+        with metrics.phase("stream"):
+            return asyncio.run(self.__run(incremental))
+
+    async def __run(self, incremental):
+        meetings = asyncio.Queue(self.queue_size)
+        records = asyncio.Queue(self.queue_size)
+        self.__read = []
+        self.__present = set()
+        self.__failed = 0
+        self.ledger.begin()
+
+        await asyncio.gather(
+            self.__produce(meetings, incremental),
+            self.__resolve(meetings, records),
+            self.__upload(records),
+        )
+
+        # as in `run_phased`, a failed run leaves its messages to the next
+        if self.__failed:
+            return False
+        await asyncio.to_thread(self.gc.mark_as_read, self.__read)
+        if incremental:
+            self.gc.commit_history()
+        self.ledger.finish()
+        return True
+
+    async def __produce(self, meetings, incremental):
+        iterator = self.gc.iter_meetings(incremental=incremental)
+        while True:
+            meeting = await asyncio.to_thread(next, iterator, None)
+            await meetings.put(meeting)
+            if meeting is None:
+                break
+
+    async def __resolve(self, meetings, records):
+        while (meeting := await meetings.get()) is not None:
+            message, meeting_code, attendees = meeting
+            missing_courses = fill_missing_courses(
+                attendees, self.gc.course_index)
+            if missing_courses:
+                print(
+                    f"Missing course for {meeting_code}, set to {missing_courses[0]} from attendee names.")
+
+            self.__present.update(
+                (attendee["Course ID"], attendee["Date"], attendee["Last name"])
+                for attendee in attendees)
+            await self.__put(records, attendees)
+            self.__read.append(message.id)
+
+        # the fields of the attendees used by `get_absentees` and `drop_present`
+        present = [{"Course ID": course_id, "Date": date, "Last name": last_name}
+                   for course_id, date, last_name in self.__present]
+        self.__present = None
+        absentees = await asyncio.to_thread(self.cc.get_absentees, present)
+        await self.__put(records, drop_present(absentees, present))
+        await records.put(None)
+
+    async def __put(self, queue, records):
+        if self.rollup is not None:
+            await asyncio.to_thread(self.rollup.add, records)
+        records = self.ledger.filter_new(records)
+        self.ledger.append(records)
+        await queue.put(records)
+
+    async def __upload(self, records):
+        batch = []
+        while (meeting_records := await records.get()) is not None:
+            batch.extend(meeting_records)
+            while len(batch) >= self.batch_size:
+                await self.__send(batch[:self.batch_size])
+                batch = batch[self.batch_size:]
+        if batch:
+            await self.__send(batch)
+
+    async def __send(self, batch):
+        results = await asyncio.to_thread(
+            self.ac.upload_many,
+            batch,
+            batch_size=self.batch_size,
+            external_id_field=self.external_id_field,
+            external_id=self.ledger.external_id,
+            callback=self.ledger.add,
+        )
+        report_results(batch, results)
+        self.__failed += sum(not result["success"] for result in results)
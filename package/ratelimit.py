@@ -0,0 +1,22 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces out calls so no more than
+    `requests_per_minute` are made, shared by every worker of a pool.
+    """
+
+    def __init__(self, requests_per_minute) -> None:
+        self.interval = 60 / requests_per_minute
+        self.__lock = threading.Lock()
+        self.__next_slot = time.monotonic()
+
+    def wait(self):
+        with self.__lock:
+            now = time.monotonic()
+            slot = max(self.__next_slot, now)
+            self.__next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
@@ -0,0 +1,164 @@
+import re
+from .index import normalize_name
+
+
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*(hr|h|min|m|sec|s)\b")
+MINUTES_PER_UNIT = {"hr": 60, "h": 60, "min": 1, "m": 1, "sec": 1 / 60, "s": 1 / 60}
+
+# sObject Collections accept at most 200 records per request. Defined here
+# rather than in salesforce.py so that batching records does not import
+# simple-salesforce.
+COLLECTION_SIZE = 200
+
+
+def parse_duration(duration):
+    """Returns the minutes of a Meet duration such as '1 hr 5 min', or None."""
+    if not duration:
+        return None
+    parts = DURATION_PATTERN.findall(duration)
+    if not parts:
+        return None
+    return round(sum(float(value) * MINUTES_PER_UNIT[unit] for value, unit in parts), 2)
+
+
+class Record:
+    """
+    Base of the attendance records uploaded to Salesforce.
+
+    Fields are attributes, and are also read and written by the keys of the
+    dictionaries records used to be ("Last name", "Course ID", ...), so
+    records and plain dictionaries (such as journaled records) are handled
+    alike. The normalized name is computed once, when the record is made.
+    """
+
+    __slots__ = ("first_name", "last_name", "date", "course",
+                 "course_id", "contact", "name_key")
+
+    # dictionary key -> attribute
+    FIELDS = {
+        "First name": "first_name",
+        "Last name": "last_name",
+        "Date": "date",
+        "Course": "course",
+        "Course ID": "course_id",
+        "HED Contact": "contact",
+    }
+
+    def __init__(self, first_name, last_name, date, course=None, course_id=None) -> None:
+        self.first_name = first_name
+        self.last_name = last_name
+        self.date = date
+        self.course = course
+        self.course_id = course_id
+        self.contact = None
+        self.name_key = self.__name_key()
+
+    def __name_key(self):
+        return normalize_name(f"{self.first_name or ''} {self.last_name or ''}")
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self.FIELDS[key])
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, self.FIELDS[key], value)
+        except KeyError:
+            raise KeyError(key) from None
+        if key in ("First name", "Last name"):
+            self.name_key = self.__name_key()
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def get(self, key, default=None):
+        if key not in self.FIELDS:
+            return default
+        return getattr(self, self.FIELDS[key])
+
+    def as_dict(self):
+        record = {key: getattr(self, attribute)
+                  for key, attribute in self.FIELDS.items()}
+        if record["HED Contact"] is None:
+            del record["HED Contact"]
+        return record
+
+    def to_salesforce(self):
+        """The record as `hed__Attendance_Event__c` fields."""
+        return {
+            "Course_Offering_ID__c": self.course,
+            "Duration__c": None,
+            "Email__c": None,
+            "First_Name__c": self.first_name,
+            "Last_Name__c": self.last_name,
+            "Time_Exited__c": None,
+            "Time__c": None,
+            "hed__Contact__c": self.contact,
+            "hed__Date__c": self.date,
+        }
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.as_dict()})"
+
+
+class Attendee(Record):
+    """A row of a Meet attendance sheet."""
+
+    __slots__ = ("email", "duration", "time_joined", "time_exited", "code", "minutes")
+
+    FIELDS = dict(Record.FIELDS, **{
+        "Email": "email",
+        "Duration": "duration",
+        "Time joined": "time_joined",
+        "Time exited": "time_exited",
+        "Code": "code",
+    })
+
+    # the sheet columns, in the order of the constructor arguments
+    COLUMNS = ("First name", "Last name", "Email",
+               "Duration", "Time joined", "Time exited")
+
+    def __init__(self, first_name, last_name, email, duration, time_joined, time_exited,
+                 date, code, course=None, course_id=None) -> None:
+        super().__init__(first_name, last_name, date, course, course_id)
+        self.email = email
+        self.duration = duration
+        self.time_joined = time_joined
+        self.time_exited = time_exited
+        self.code = code
+        self.minutes = parse_duration(duration)
+
+    @classmethod
+    def column_indexes(cls, headers):
+        """The position of every column in a sheet with these headers
+        (None for missing columns), to build attendees from its rows."""
+        return tuple(headers.index(column) if column in headers else None
+                     for column in cls.COLUMNS)
+
+    @classmethod
+    def from_row(cls, row, indexes, date, code, course=None, course_id=None):
+        return cls(*(row[index] if index is not None else None for index in indexes),
+                   date, code, course, course_id)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if key == "Duration":
+            self.minutes = parse_duration(value)
+
+    def to_salesforce(self):
+        record = super().to_salesforce()
+        record.update({
+            "Duration__c": self.duration,
+            "Email__c": self.email,
+            "Time_Exited__c": self.time_exited,
+            "Time__c": self.time_joined,
+        })
+        return record
+
+
+class Absentee(Record):
+    """A student of a course roster who did not attend a meeting."""
+
+    __slots__ = ()
@@ -0,0 +1,194 @@
+import sqlite3
+import threading
+from .index import normalize_name
+from .ledger import Ledger
+from .records import COLLECTION_SIZE, parse_duration
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counted (
+    course_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    code TEXT NOT NULL,
+    PRIMARY KEY (course_id, name, date, code)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS days (
+    course TEXT NOT NULL,
+    student TEXT NOT NULL,
+    date TEXT NOT NULL,
+    attended INTEGER NOT NULL,
+    PRIMARY KEY (course, student, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup (
+    course TEXT NOT NULL,
+    student TEXT NOT NULL,
+    first_name TEXT,
+    last_name TEXT,
+    attended INTEGER NOT NULL DEFAULT 0,
+    absent INTEGER NOT NULL DEFAULT 0,
+    minutes REAL NOT NULL DEFAULT 0,
+    first_seen TEXT,
+    last_seen TEXT,
+    pushed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (course, student)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS rollup_pushed ON rollup (pushed);
+"""
+
+ROLLUP_COLUMNS = ("course", "student", "first_name", "last_name", "attended",
+                  "absent", "minutes", "first_seen", "last_seen")
+
+# Salesforce field of every rollup column pushed by `push`.
+SALESFORCE_FIELDS = {
+    "attended": "Attendance_Count__c",
+    "absent": "Absence_Count__c",
+    "minutes": "Attendance_Minutes__c",
+    "first_seen": "First_Attended__c",
+    "last_seen": "Last_Attended__c",
+}
+
+
+class Rollup:
+    """
+    Local per-course, per-student attendance statistics: days attended and
+    missed, total minutes (from the "Duration" of the attendance sheets)
+    and the dates of the first and last meeting attended.
+
+    Days are counted like absentees are found: a student at any meeting of
+    a course on a day attended it that day, even if an absence was counted
+    first. Minutes add up over every meeting.
+
+    The rollup is updated with `add` as records are produced. Every record
+    is counted once, by its ledger key, so records seen again (a message
+    processed twice, a resumed run) do not change the totals. Students are
+    keyed by their normalized name, courses by ID (or course code when the
+    meeting is not linked with a course).
+    """
+
+    def __init__(self, path="data/rollup.db") -> None:
+        self.path = path
+        self.__lock = threading.RLock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.row_factory = sqlite3.Row
+        with self.__connection:
+            self.__connection.executescript(SCHEMA)
+
+    def close(self):
+        self.__connection.close()
+
+    def add(self, records):
+        """Counts the records (attendees and absentees) not counted yet.
+        Returns the number of records counted."""
+        counted = 0
+        with self.__lock, self.__connection:
+            for record in records:
+                key = Ledger.key(record)
+                if not self.__connection.execute(
+                        "INSERT OR IGNORE INTO counted VALUES (?, ?, ?, ?)", key).rowcount:
+                    continue
+                counted += 1
+
+                course_id, student, date, _ = key
+                course = course_id or record.get("Course") or ""
+                attended = "Duration" in record
+                if attended:
+                    minutes = getattr(record, "minutes", None)
+                    if minutes is None:
+                        minutes = parse_duration(record.get("Duration"))
+
+                day = self.__connection.execute(
+                    "SELECT attended FROM days WHERE course = ? AND student = ? AND date = ?",
+                    (course, student, date)).fetchone()
+                # (days attended, days absent) to add
+                if day is None:
+                    days = (1, 0) if attended else (0, 1)
+                elif attended and not day[0]:
+                    days = (1, -1)
+                else:
+                    days = (0, 0)
+                self.__connection.execute(
+                    "INSERT INTO days VALUES (?, ?, ?, ?) ON CONFLICT (course, student, date) "
+                    "DO UPDATE SET attended = MAX(attended, excluded.attended)",
+                    (course, student, date, int(attended)))
+                self.__connection.execute(
+                    "INSERT INTO rollup (course, student, first_name, last_name, attended, absent, "
+                    "minutes, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (course, student) DO UPDATE SET "
+                    "attended = attended + excluded.attended, "
+                    "absent = absent + excluded.absent, "
+                    "minutes = minutes + excluded.minutes, "
+                    "first_seen = CASE WHEN first_seen IS NULL OR excluded.first_seen < first_seen "
+                    "THEN excluded.first_seen ELSE first_seen END, "
+                    "last_seen = CASE WHEN last_seen IS NULL OR excluded.last_seen > last_seen "
+                    "THEN excluded.last_seen ELSE last_seen END, "
+                    "pushed = 0",
+                    (
+                        course,
+                        student,
+                        record.get("First name"),
+                        record.get("Last name"),
+                        *days,
+                        (minutes or 0) if attended else 0,
+                        date if attended else None,
+                        date if attended else None,
+                    )
+                )
+        return counted
+
+    def student(self, course, name):
+        """Returns the statistics of a student of a course, or None."""
+        with self.__lock:
+            row = self.__connection.execute(
+                f"SELECT {', '.join(ROLLUP_COLUMNS)} FROM rollup WHERE course = ? AND student = ?",
+                (course, normalize_name(name))
+            ).fetchone()
+        return dict(row) if row else None
+
+    def course(self, course):
+        """Returns the statistics of every student of a course, lowest
+        attendance first."""
+        with self.__lock:
+            rows = self.__connection.execute(
+                f"SELECT {', '.join(ROLLUP_COLUMNS)} FROM rollup WHERE course = ? "
+                "ORDER BY CAST(attended AS REAL) / (attended + absent), student",
+                (course,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def push(self, ac, sobject, external_id_field, batch_size=COLLECTION_SIZE):
+        """
+        Upserts the statistics changed since the last push into `sobject`,
+        one record per course and student, matched on `external_id_field`
+        ("<course>|<student>"), with the fields of `SALESFORCE_FIELDS`.
+        `ac` is the `AttendanceClient` that upserts them. Returns the number
+        of records pushed.
+        """
+        with self.__lock:
+            rows = [dict(row) for row in self.__connection.execute(
+                f"SELECT {', '.join(ROLLUP_COLUMNS)} FROM rollup WHERE pushed = 0").fetchall()]
+
+        pushed = 0
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            results = ac.upsert_collection(sobject, external_id_field, [
+                dict(
+                    {field: row[column] for column, field in SALESFORCE_FIELDS.items()},
+                    **{external_id_field: f'{row["course"]}|{row["student"]}'}
+                )
+                for row in batch
+            ])
+
+            done = [(row["course"], row["student"])
+                    for row, result in zip(batch, results) if result.get("success")]
+            for row, result in zip(batch, results):
+                if not result.get("success"):
+                    errors = "; ".join(error.get("message", "")
+                                       for error in result.get("errors", []))
+                    print(
+                        f'Failed to push the statistics of {row["student"]} ({row["course"]}): {errors}')
+            with self.__lock, self.__connection:
+                self.__connection.executemany(
+                    "UPDATE rollup SET pushed = 1 WHERE course = ? AND student = ?", done)
+            pushed += len(done)
+        return pushed
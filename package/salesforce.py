@@ -1,17 +1,143 @@
+import csv
+import io
+import json
+import time
 from simple_salesforce import SalesforceLogin, SFType
+from simple_salesforce.exceptions import SalesforceError, SalesforceExpiredSession
+from .index import normalize_name
+from .metrics import metrics
+from .records import COLLECTION_SIZE, Record
+
+
+API_VERSION = "59.0"
 
 
 class AttendanceClient(SFType):
 
-    def __init__(self, username, password, security_token):
+    def __init__(self, username, password, security_token, session_path="data/salesforce_session.json", session=None):
+        """`session` is an optional requests.Session used for every request."""
+        self.username = username
+        self.password = password
+        self.security_token = security_token
+        self.session_path = session_path
+        self.__requests_session = session
+
+        # A session from an earlier run is reused until Salesforce rejects
+        # it, instead of logging in on every run.
+        session = self.__load_session()
+        if session is None:
+            session = self.__login()
+
+        super().__init__("hed__Attendance_Event__c", session["session_id"],
+                         session["instance"], sf_version=API_VERSION,
+                         session=self.__requests_session)
+        self.__use_session(session)
+        self.contacts = ContactResolver(self)
+
+    def __load_session(self):
+        try:
+            with open(self.session_path) as file:
+                session = json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return None
+        if session.get("username") != self.username:
+            return None
+        return session
+
+    def __login(self):
         session_id, instance = SalesforceLogin(
-            username=username,
+            username=self.username,
             domain="login",
-            password=password,
-            security_token=security_token
+            password=self.password,
+            security_token=self.security_token,
+            sf_version=API_VERSION,
+            session=self.__requests_session
         )
+        session = {"username": self.username,
+                   "session_id": session_id, "instance": instance}
+        with open(self.session_path, "w") as file:
+            file.write(json.dumps(session))
+        return session
+
+    def __use_session(self, session):
+        # SFType.session_id is a read-only property over _session_id
+        self._session_id = session["session_id"]
+        self.sf_instance = session["instance"]
+        self.data_url = f"https://{self.sf_instance}/services/data/v{API_VERSION}/"
+        self.base_url = f"{self.data_url}sobjects/{self.name}/"
+
+    def _call_salesforce(self, method, url, **kwargs):
+        try:
+            return self.__timed_call(method, url, **kwargs)
+        except SalesforceExpiredSession:
+            print("Salesforce session expired, logging in again.")
+            metrics.record_retry("salesforce")
+            old_data_url = self.data_url
+            self.__use_session(self.__login())
+            return self.__timed_call(
+                method, url.replace(old_data_url, self.data_url), **kwargs)
 
-        super().__init__("hed__Attendance_Event__c", session_id, instance)
+    def __timed_call(self, method, url, **kwargs):
+        # every request is recorded in metrics, with the API usage sent back
+        started = time.perf_counter()
+        try:
+            response = super()._call_salesforce(method, url, **kwargs)
+        except SalesforceError as e:
+            metrics.record("salesforce", e.status,
+                           time.perf_counter() - started)
+            raise
+        except Exception:
+            metrics.record("salesforce", None, time.perf_counter() - started)
+            raise
+        metrics.record("salesforce", response.status_code,
+                       time.perf_counter() - started, len(response.content))
+        metrics.record_salesforce_limits(
+            response.headers.get("Sforce-Limit-Info"))
+        return response
+
+    def query_all(self, soql):
+        """Returns every record matched by a SOQL query."""
+        records = []
+        response = self._call_salesforce(
+            "GET", self.data_url + "query/", params={"q": soql}).json()
+        records.extend(response["records"])
+        while not response["done"]:
+            response = self._call_salesforce(
+                "GET", f"https://{self.sf_instance}{response['nextRecordsUrl']}").json()
+            records.extend(response["records"])
+        return records
+
+    def upsert_collection(self, sobject, external_id_field, records):
+        """Upserts up to COLLECTION_SIZE records of `sobject`, matched on
+        `external_id_field`, in one request. Returns a result per record."""
+        payload = {
+            "allOrNone": False,
+            "records": [
+                dict(record, attributes={"type": sobject}) for record in records
+            ],
+        }
+        response = self._call_salesforce(
+            "PATCH", f"{self.data_url}composite/sobjects/{sobject}/{external_id_field}",
+            data=json.dumps(payload))
+        return response.json()
+
+    @staticmethod
+    def to_record(raw_data: dict):
+        """Maps an attendee/absentee (a `Record` or a dictionary) to the
+        Salesforce fields."""
+        if isinstance(raw_data, Record):
+            return raw_data.to_salesforce()
+        return {
+            "Course_Offering_ID__c": raw_data.get("Course"),
+            "Duration__c": raw_data.get("Duration"),
+            "Email__c": raw_data.get("Email"),
+            "First_Name__c": raw_data.get("First name"),
+            "Last_Name__c": raw_data.get("Last name"),
+            "Time_Exited__c": raw_data.get("Time exited"),
+            "Time__c": raw_data.get("Time joined"),
+            "hed__Contact__c": raw_data.get("HED Contact"),  # see ContactResolver
+            "hed__Date__c": raw_data.get("Date"),
+        }
 
     def upload(self, raw_data: dict):
         """
@@ -30,16 +156,285 @@ class AttendanceClient(SFType):
         }
         """
 
-        data = {
-            "Course_Offering_ID__c": raw_data.get("Course"),
-            "Duration__c": raw_data.get("Duration"),
-            "Email__c": raw_data.get("Email"),
-            "First_Name__c": raw_data.get("First name"),
-            "Last_Name__c": raw_data.get("Last name"),
-            "Time_Exited__c": raw_data.get("Time exited"),
-            "Time__c": raw_data.get("Time joined"),
-            "hed__Contact__c": raw_data.get("HED Contact"),  # always None
-            "hed__Date__c": raw_data.get("Date"),
+        return self.create(self.to_record(raw_data))
+
+    def upload_many(self, raw_data: list[dict], batch_size=COLLECTION_SIZE, bulk_threshold=2000,
+                    external_id_field=None, external_id=None, callback=None, resolve_contacts=True,
+                    bulk_timeout=600):
+        """
+        Uploads a list of attendance records (same format as `upload`).
+
+        Lists smaller than `bulk_threshold` are sent through sObject
+        Collections, `batch_size` records per request. Larger lists are
+        sent as a single Bulk API 2.0 ingest job, falling back to
+        collections if the job cannot be created or its data uploaded.
+        Once the job is closed for upload there is no fallback (the records
+        may already be inserted): the job's results are reported, and a job
+        still running after `bulk_timeout` seconds is aborted.
+
+        If `external_id_field` is given, records are upserted on that field
+        instead of created, with `external_id(raw_data)` as its value.
+
+        `callback(raw_data, results)` is called after every request with
+        the records it sent, so progress can be saved as it is made.
+
+        Unless `resolve_contacts` is False, the records are linked with
+        their contacts through `self.contacts` first.
+
+        Returns one result per input record, in the same order:
+        {"id": "a0X...", "success": True, "errors": []}
+        Records a closed bulk job may or may not have created (its results
+        could not be read) fail with "unknown_job", the job ID, unless they
+        were upserted.
+        """
+        if not raw_data:
+            return []
+        if resolve_contacts:
+            self.contacts.resolve(raw_data)
+        records = [self.to_record(data) for data in raw_data]
+        if external_id_field:
+            for record, data in zip(records, raw_data):
+                record[external_id_field] = external_id(data)
+
+        if len(records) >= bulk_threshold:
+            try:
+                results = self.__bulk_insert(
+                    records, external_id_field, timeout=bulk_timeout)
+            except SalesforceError as e:
+                print(f"Bulk upload failed ({e}), falling back to collections.")
+            else:
+                if callback:
+                    callback(raw_data, results)
+                return results
+
+        results = []
+        batch_size = max(1, min(batch_size, COLLECTION_SIZE))
+        for start in range(0, len(records), batch_size):
+            batch_results = self.__collection_insert(
+                records[start:start + batch_size], external_id_field)
+            if callback:
+                callback(raw_data[start:start + batch_size], batch_results)
+            results.extend(batch_results)
+        return results
+
+    def __collection_insert(self, records, external_id_field=None):
+        # If the whole chunk is rejected for its content (as opposed to
+        # individual records failing), retry it in halves until the offending
+        # record is isolated. Other errors (API limits, outages) fail it.
+        payload = {
+            "allOrNone": False,
+            "records": [
+                dict(record, attributes={"type": self.name}) for record in records
+            ],
         }
+        if external_id_field:
+            method = "PATCH"
+            url = f"{self.data_url}composite/sobjects/{self.name}/{external_id_field}"
+        else:
+            method = "POST"
+            url = self.data_url + "composite/sobjects"
+        try:
+            response = self._call_salesforce(
+                method, url, data=json.dumps(payload))
+        except SalesforceError as e:
+            if e.status != 400 or len(records) == 1:
+                return [self.__failure(str(e)) for _ in records]
+            middle = len(records) // 2
+            return (self.__collection_insert(records[:middle], external_id_field) +
+                    self.__collection_insert(records[middle:], external_id_field))
+
+        return [
+            {
+                "id": result.get("id"),
+                "success": result.get("success", False),
+                "errors": result.get("errors", []),
+            }
+            for result in response.json()
+        ]
+
+    def __bulk_insert(self, records, external_id_field=None, poll_interval=2, timeout=600):
+        jobs_url = self.data_url + "jobs/ingest/"
+        columns = list(records[0].keys())
+
+        job = {
+            "object": self.name,
+            "operation": "insert",
+            "contentType": "CSV",
+            "lineEnding": "LF",
+        }
+        if external_id_field:
+            job["operation"] = "upsert"
+            job["externalIdFieldName"] = external_id_field
+        job = self._call_salesforce(
+            "POST", jobs_url, data=json.dumps(job)).json()
+        job_url = jobs_url + job["id"] + "/"
+
+        self._call_salesforce(
+            "PUT", job_url + "batches",
+            data=self.__to_csv(columns, records).encode("utf-8"),
+            headers={"Content-Type": "text/csv"}
+        )
+        # Errors up to here are raised: nothing was inserted and the caller
+        # falls back to collections. Errors after are reported as failures.
+        self._call_salesforce(
+            "PATCH", job_url, data=json.dumps({"state": "UploadComplete"}))
+
+        try:
+            state = self.__wait_for_job(job_url, poll_interval, timeout)
+            return self.__job_results(job_url, columns, records, state)
+        except SalesforceError as e:
+            print(f"Could not get the results of bulk job {job['id']} ({e}).")
+            if external_id_field:
+                # upserts can be sent again without creating duplicates
+                return [self.__failure(f"Result unknown (bulk job {job['id']}).")
+                        for _ in records]
+            return [
+                dict(self.__failure(f"Result unknown (bulk job {job['id']}); check the job before retrying."),
+                     unknown_job=job["id"])
+                for _ in records
+            ]
+
+    def __wait_for_job(self, job_url, poll_interval, timeout):
+        deadline = time.monotonic() + timeout
+        state = None
+        while state not in ("JobComplete", "Failed", "Aborted"):
+            if time.monotonic() >= deadline:
+                # the records processed so far stay inserted and are
+                # reported with the job's results
+                print(f"Bulk job still {state} after {timeout} seconds, aborting it.")
+                state = self._call_salesforce(
+                    "PATCH", job_url, data=json.dumps({"state": "Aborted"})).json()["state"]
+                break
+            time.sleep(poll_interval)
+            state = self._call_salesforce("GET", job_url).json()["state"]
+        return state
+
+    def __job_results(self, job_url, columns, records, state):
+        # Bulk results are not returned in input order, so they are matched
+        # back to the input records by their column values.
+        pending = {}
+        for index, record in enumerate(records):
+            key = tuple(self.__csv_value(record[column]) for column in columns)
+            pending.setdefault(key, []).append(index)
+
+        results = [None] * len(records)
+        for kind in ("successfulResults", "failedResults"):
+            text = self._call_salesforce(
+                "GET", job_url + kind, headers={"Accept": "text/csv"}).text
+            for row in csv.DictReader(io.StringIO(text)):
+                key = tuple(row.get(column, "") for column in columns)
+                if not pending.get(key):
+                    continue
+                index = pending[key].pop(0)
+                if kind == "successfulResults":
+                    results[index] = {
+                        "id": row["sf__Id"], "success": True, "errors": []}
+                else:
+                    results[index] = self.__failure(row.get("sf__Error"))
+
+        return [
+            result or self.__failure(f"Record not processed (job {state}).")
+            for result in results
+        ]
+
+    @staticmethod
+    def __csv_value(value):
+        return "" if value is None else str(value)
+
+    def __to_csv(self, columns, records):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(columns)
+        for record in records:
+            writer.writerow([self.__csv_value(record[column])
+                            for column in columns])
+        return buffer.getvalue()
+
+    @staticmethod
+    def __failure(message):
+        return {"id": None, "success": False, "errors": [{"message": message}]}
+
+
+class ContactResolver:
+    """
+    Links attendance records with their Contact. Contacts are loaded with
+    one SOQL query per batch of unknown emails and names, and kept in
+    memory indexed by email and by normalized full name, so records are
+    resolved without a query each. Names shared by several contacts are
+    not used.
+    """
+
+    # values per IN clause, keeping queries well under the SOQL length limit
+    CHUNK_SIZE = 200
+
+    def __init__(self, client: AttendanceClient, miss_ttl=3600) -> None:
+        self.client = client
+        self.miss_ttl = miss_ttl
+        self.__by_email = {}
+        self.__by_name = {}
+        # keys that matched no contact, with the time they were looked up
+        self.__misses = {}
+
+    @staticmethod
+    def __quote(value):
+        return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+    @staticmethod
+    def __keys(record):
+        email = (record.get("Email") or "").strip().lower()
+        if isinstance(record, Record):
+            return email, record.name_key
+        name = normalize_name(
+            f'{record.get("First name") or ""} {record.get("Last name") or ""}')
+        return email, name
+
+    def __is_known(self, index, key):
+        if key in index:
+            return True
+        missed = self.__misses.get(key)
+        return missed is not None and time.monotonic() - missed < self.miss_ttl
+
+    def load(self, records):
+        """Queries the contacts of the records that are not known yet."""
+        emails, names = set(), set()
+        for record in records:
+            email, name = self.__keys(record)
+            if email and not self.__is_known(self.__by_email, email):
+                emails.add(email)
+            if name and not self.__is_known(self.__by_name, name):
+                names.add(name)
+
+        for field, values in (("Email", sorted(emails)), ("Name", sorted(names))):
+            for start in range(0, len(values), self.CHUNK_SIZE):
+                chunk = values[start:start + self.CHUNK_SIZE]
+                contacts = self.client.query_all(
+                    f"SELECT Id, Name, Email FROM Contact WHERE {field} IN "
+                    f"({', '.join(self.__quote(value) for value in chunk)})"
+                )
+                for contact in contacts:
+                    self.__add(contact)
+                now = time.monotonic()
+                for value in chunk:
+                    if value not in self.__by_email and value not in self.__by_name:
+                        self.__misses[value] = now
+
+    def __add(self, contact):
+        if contact.get("Email"):
+            self.__by_email[contact["Email"].strip().lower()] = contact["Id"]
+        if contact.get("Name"):
+            name = normalize_name(contact["Name"])
+            if self.__by_name.get(name, contact["Id"]) != contact["Id"]:
+                self.__by_name[name] = None  # ambiguous
+            else:
+                self.__by_name[name] = contact["Id"]
 
-        return self.create(data)
+    def resolve(self, records):
+        """Sets "HED Contact" on every record whose contact is found."""
+        self.load(records)
+        for record in records:
+            email, name = self.__keys(record)
+            contact_id = self.__by_email.get(email) if email else None
+            if contact_id is None:
+                contact_id = self.__by_name.get(name)
+            if contact_id:
+                record["HED Contact"] = contact_id
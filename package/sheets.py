@@ -1,8 +1,7 @@
+from .cache import SheetCache
 from .client import BaseClient
 from googleapiclient.errors import HttpError
 
-import time
-
 
 class SheetsClient(BaseClient):
 
@@ -11,6 +10,7 @@ class SheetsClient(BaseClient):
             client_secret_path="data/secret.json",
             credentials_path="data/credentials.json",
             courses_path="data/courses.json",
+            cache_path="data/sheet_cache.db",
             force_renew=False
     ) -> None:
         super().__init__(
@@ -24,33 +24,56 @@ class SheetsClient(BaseClient):
             ],
             force_renew
         )
+        self.cache = SheetCache(cache_path) if cache_path else None
+
+    @staticmethod
+    def __to_values(grid):
+        # Mirrors values().get: empty trailing cells and rows are dropped.
+        rows = []
+        for row_data in grid.get("rowData", []):
+            row = [cell.get("formattedValue", "")
+                   for cell in row_data.get("values", [])]
+            while row and row[-1] == "":
+                row.pop()
+            rows.append(row)
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def get_spreadsheet(self, spreadsheetId, range_="Attendees", http=None, revision=""):
+        """
+        Returns the title and the values of a range of a spreadsheet, or
+        None if it could not be read. Spreadsheets are served from the cache
+        when it has them at `revision`.
+        """
+        cache_key = f"{spreadsheetId}!{range_}"
+        if self.cache:
+            cached = self.cache.get(cache_key, revision)
+            if cached is not None:
+                return cached
+
+        # The title and the values of the range are fetched in one request.
+        request = self.service.spreadsheets().get(
+            spreadsheetId=spreadsheetId,
+            ranges=range_,
+            includeGridData=True,
+            fields="properties.title,sheets.data.rowData.values.formattedValue"
+        )
+        try:
+            data = self.execute(request, http=http)
+        except (TimeoutError, ConnectionError, HttpError) as e:
+            print(f"Google spreadsheets' read operation failed ({e}).")
+            return None
+
+        try:
+            grid = data["sheets"][0]["data"][0]
+        except (KeyError, IndexError):
+            grid = {}
 
-    def get_spreadsheet(self, spreadsheetId, range_="Attendees"):
-        spreadsheet = {}
-        for _ in range(5):
-            try:
-                time.sleep(1)
-
-                spreadsheet["data"] = list(
-                    (self
-                        .service
-                        .spreadsheets()
-                        .values()
-                        .get(spreadsheetId=spreadsheetId, range=range_)
-                        .execute()
-                     )
-                    .get("values"))
-
-                data = (self
-                        .service
-                        .spreadsheets()
-                        .get(spreadsheetId=spreadsheetId)
-                        .execute()
-                        )
-                spreadsheet["title"] = data.get("properties").get("title")
-                return spreadsheet
-
-            except (TimeoutError, HttpError):
-                print("Google spreadsheets' read operation timed out, trying again.")
-
-        return None
+        spreadsheet = {
+            "title": data.get("properties").get("title"),
+            "data": self.__to_values(grid),
+        }
+        if self.cache:
+            self.cache.put(cache_key, spreadsheet, revision)
+        return spreadsheet
@@ -0,0 +1,206 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from .index import meet_codes
+
+
+COURSE_COLUMNS = ("id", "name", "link", "description",
+                  "meet_link", "time_created", "time_updated")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS courses (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    link TEXT,
+    description TEXT,
+    meet_link TEXT,
+    time_created TEXT,
+    time_updated TEXT
+);
+CREATE TABLE IF NOT EXISTS meet_codes (
+    code TEXT NOT NULL,
+    course_id TEXT NOT NULL REFERENCES courses(id),
+    PRIMARY KEY (code, course_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rosters (
+    course_id TEXT PRIMARY KEY,
+    checked TEXT
+);
+CREATE TABLE IF NOT EXISTS students (
+    course_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    full_name TEXT,
+    PRIMARY KEY (course_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sync_pending (
+    course_id TEXT PRIMARY KEY
+);
+"""
+
+
+class Database:
+    """
+    SQLite store of the courses and their student rosters.
+
+    Courses are indexed by ID and by every Meet code found in their Meet
+    link, and each roster is replaced in its own transaction. On first use
+    the store is filled from the old `courses.json`/`students.json` files
+    if they exist.
+    """
+
+    def __init__(self, path="data/attendance.db", courses_path="data/courses.json", students_path="data/students.json") -> None:
+        self.path = path
+        self.__lock = threading.RLock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.row_factory = sqlite3.Row
+        with self.__connection:
+            self.__connection.executescript(SCHEMA)
+            # databases created before rosters were timestamped
+            columns = [row["name"] for row in self.__connection.execute(
+                "PRAGMA table_info(rosters)")]
+            if "checked" not in columns:
+                self.__connection.execute(
+                    "ALTER TABLE rosters ADD COLUMN checked TEXT")
+
+        if self.is_empty():
+            self.migrate_json(courses_path, students_path)
+
+    def close(self):
+        self.__connection.close()
+
+    def is_empty(self):
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT EXISTS(SELECT 1 FROM courses) OR EXISTS(SELECT 1 FROM rosters)").fetchone()
+        return not row[0]
+
+    def migrate_json(self, courses_path, students_path):
+        """Imports the courses and students of the old JSON database."""
+        try:
+            with open(courses_path) as file:
+                courses = json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            courses = {}
+        try:
+            with open(students_path) as file:
+                students = json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            students = {}
+
+        if not (courses or students):
+            return
+
+        self.upsert_courses(courses.values())
+        with self.__lock, self.__connection:
+            for course_id, names in students.items():
+                self.__replace_roster(course_id, names)
+        print(
+            f"Migrated {len(courses)} courses and {len(students)} rosters into {self.path}")
+
+    def upsert_courses(self, courses):
+        """Inserts or updates courses given as dictionaries (`Course.as_dict`)."""
+        with self.__lock, self.__connection:
+            for course in courses:
+                self.__connection.execute(
+                    f"INSERT INTO courses ({', '.join(COURSE_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(COURSE_COLUMNS))}) "
+                    f"ON CONFLICT (id) DO UPDATE SET "
+                    f"{', '.join(f'{column} = excluded.{column}' for column in COURSE_COLUMNS[1:])}",
+                    [course.get(column) for column in COURSE_COLUMNS]
+                )
+                self.__connection.execute(
+                    "DELETE FROM meet_codes WHERE course_id = ?", (course["id"],))
+                self.__connection.executemany(
+                    "INSERT OR IGNORE INTO meet_codes (code, course_id) VALUES (?, ?)",
+                    [(code, course["id"])
+                     for code in meet_codes(course.get("meet_link"))]
+                )
+
+    def replace_roster(self, course_id, names):
+        """Stores the roster of a course and clears it from the pending sync
+        in one transaction."""
+        with self.__lock, self.__connection:
+            self.__replace_roster(course_id, names)
+            self.__connection.execute(
+                "DELETE FROM sync_pending WHERE course_id = ?", (course_id,))
+
+    def roster_checked(self, course_id):
+        """Records that the stored roster of a course was found up to date,
+        and clears it from the pending sync."""
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                "UPDATE rosters SET checked = ? WHERE course_id = ?",
+                (datetime.now(timezone.utc).isoformat(), course_id))
+            self.__connection.execute(
+                "DELETE FROM sync_pending WHERE course_id = ?", (course_id,))
+
+    def get_roster_checks(self):
+        """Returns when the roster of every course was last fetched (an
+        aware datetime, or None if unknown), keyed by course ID."""
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT course_id, checked FROM rosters").fetchall()
+        return {row[0]: datetime.fromisoformat(row[1]) if row[1] else None
+                for row in rows}
+
+    def __replace_roster(self, course_id, names):
+        self.__connection.execute(
+            "INSERT INTO rosters (course_id, checked) VALUES (?, ?) "
+            "ON CONFLICT (course_id) DO UPDATE SET checked = excluded.checked",
+            (course_id, datetime.now(timezone.utc).isoformat()))
+        self.__connection.execute(
+            "DELETE FROM students WHERE course_id = ?", (course_id,))
+        self.__connection.executemany(
+            "INSERT INTO students (course_id, position, full_name) VALUES (?, ?, ?)",
+            [(course_id, position, name) for position, name in enumerate(names)]
+        )
+
+    def get_course(self, course_id):
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT * FROM courses WHERE id = ?", (course_id,)).fetchone()
+        return dict(row) if row else None
+
+    def find_course(self, code):
+        """Returns the course whose Meet link has the normalized code, or None."""
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT courses.* FROM meet_codes JOIN courses ON courses.id = meet_codes.course_id "
+                "WHERE meet_codes.code = ? ORDER BY courses.rowid LIMIT 1", (code,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def get_courses(self):
+        """Returns every course, keyed by ID."""
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT * FROM courses ORDER BY rowid").fetchall()
+        return {row["id"]: dict(row) for row in rows}
+
+    def get_roster(self, course_id):
+        """Returns the student names of a course, or None if its roster was
+        never fetched."""
+        with self.__lock:
+            if not self.__connection.execute(
+                    "SELECT 1 FROM rosters WHERE course_id = ?", (course_id,)).fetchone():
+                return None
+            rows = self.__connection.execute(
+                "SELECT full_name FROM students WHERE course_id = ? ORDER BY position",
+                (course_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def get_pending(self):
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT course_id FROM sync_pending").fetchall()
+        return {row[0] for row in rows}
+
+    def set_pending(self, course_ids):
+        with self.__lock, self.__connection:
+            self.__connection.execute("DELETE FROM sync_pending")
+            self.__connection.executemany(
+                "INSERT INTO sync_pending (course_id) VALUES (?)",
+                [(course_id,) for course_id in course_ids]
+            )
@@ -16,13 +16,7 @@ cc = ClassroomClient(force_renew=force_renew)
 ac = AttendanceClient(username, password, security_token)
 
 
-submissions = []
-coursework = cc.service.courses().courseWork()
-response = coursework.studentSubmissions().list(
-    courseId="695918984719",
-    courseWorkId="-",
-    pageSize=10).execute()
-submissions.extend(response.get('studentSubmissions', []))
+submissions = cc.get_submissions("695918984719")
 
 if not submissions:
     print('No student submissions found.')